@@ -27,7 +27,11 @@ input() will create a string at runtime, it can't do that optimization,
 so a new string object is created.
 """
 
+from __future__ import print_function
+
 import copy
+import copyreg
+import weakref
 
 
 class UserDefinedObj(object):
@@ -44,9 +48,9 @@ def assign():
     # the original object, not a copy.
     a = [1, 2, 3]
     b = a
-    print "{a:%s}-{b:%s}" % (a, b)
+    print("{a:%s}-{b:%s}" % (a, b))
     a.append(6)
-    print "{a:%s}-{b:%s}" % (a, b)
+    print("{a:%s}-{b:%s}" % (a, b))
 
 
 def shallow_copy():
@@ -54,37 +58,37 @@ def shallow_copy():
     existing_list = [1, 2, 3]
     new_list = copy.copy(existing_list)
     # not the same object
-    print existing_list is new_list
-    print existing_list == new_list
-    print "{existing:%s}-{new:%s}" % (existing_list, new_list)
+    print(existing_list is new_list)
+    print(existing_list == new_list)
+    print("{existing:%s}-{new:%s}" % (existing_list, new_list))
     new_list[0] = 6
-    print "{existing:%s}-{new:%s}" % (existing_list, new_list)
+    print("{existing:%s}-{new:%s}" % (existing_list, new_list))
 
     # case 2:
     a = [['foo'], [1, 2], ['bar', 23]]
     b = copy.copy(a)
-    print "{a:%s}-{b:%s}" % (a, b)
+    print("{a:%s}-{b:%s}" % (a, b))
     # only a will be changed
     a.append(['new'])
-    print "{a:%s}-{b:%s}" % (a, b)
+    print("{a:%s}-{b:%s}" % (a, b))
     # both a and b will be changed
     a[1].append('boo')
-    print "{a:%s}-{b:%s}" % (a, b)
+    print("{a:%s}-{b:%s}" % (a, b))
 
     # case 3:
     udo = UserDefinedObj("test")
     new_udo = copy.copy(udo)
-    print udo is new_udo
+    print(udo is new_udo)
 
     # !!! True since it's not copied recursively
-    print udo.my_list is new_udo.my_list
+    print(udo.my_list is new_udo.my_list)
 
     # case 4: for string
     s1 = 'cat'
     s2 = copy.copy(s1)
     # The is operator checks whether two objects are not merely equal (use ==),
     # but in fact the same object
-    print "string copied:%s" % (s1 is s2)
+    print("string copied:%s" % (s1 is s2))
 
 
 def deep_copy():
@@ -92,13 +96,181 @@ def deep_copy():
     # recursively, use deepcopy
     udo = UserDefinedObj("test")
     new_udo = copy.deepcopy(udo)
-    print udo is new_udo
+    print(udo is new_udo)
 
     # False
-    print udo.my_list is new_udo.my_list
+    print(udo.my_list is new_udo.my_list)
+
+
+"""Deep copies with cached per-class copy plans.
+
+copy.deepcopy rediscovers how to copy every object it meets: it looks the
+type up in its dispatch table, falls back to __reduce_ex__ for instances,
+rebuilds the instance from the reduce tuple and deep-copies its state dict
+through another round of the same, one recursive call per object. When you
+copy millions of objects of a handful of classes, all those questions have
+the same answers every time.
+
+fast_deepcopy asks them once per class and caches the answer, a copy plan:
+- ATOMIC: immutable, the copy shares the original (numbers, strings, ...);
+- LIST, DICT: shallow-copy at C speed, then recurse only into the items
+  that are not atomic;
+- TUPLE: shared as is if all its items are atomic, otherwise rebuilt once
+  its items are copied;
+- INSTANCE: a plain instance of a user-defined class whose pickling is not
+  customized (no __reduce__, __getstate__, __setstate__, __getnewargs__ or
+  copyreg registration): make it with cls.__new__, copy its __dict__ like
+  a dict;
+- HOOK: the class defines __deepcopy__, so let it do its own thing;
+- FALLBACK: anything else (sets, slots, __reduce__ overrides, subclasses of
+  builtins, ...) goes to copy.deepcopy, sharing our memo.
+Instead of recursing, fast_deepcopy keeps an explicit stack of
+(original, container to put the copy in, key) entries, so a deeply nested
+graph can't hit the recursion limit. Dict keys are shared, not copied:
+they are immutable in practice.
+"""
+
+ATOMIC, LIST, DICT, TUPLE, INSTANCE, HOOK, FALLBACK = range(7)
+
+_copy_plans = dict.fromkeys(
+    [type(None), int, float, bool, complex, str, bytes, type, range,
+     type(Ellipsis), type(NotImplemented), type(len), type(lambda: None),
+     property, weakref.ref], ATOMIC)
+_copy_plans.update({list: LIST, dict: DICT, tuple: TUPLE})
+
+# marks the stack entry that turns a tuple's copied items into a tuple
+_BUILD_TUPLE = object()
+_MISSING = object()
+
+
+def copy_plan(cls):
+    """Return (and cache) how fast_deepcopy copies instances of cls."""
+    try:
+        return _copy_plans[cls]
+    except KeyError:
+        pass
+    if getattr(cls, '__deepcopy__', None) is not None:
+        plan = HOOK
+    elif (all(c.__module__ != 'builtins' for c in cls.__mro__[:-1]) and
+          cls.__reduce_ex__ is object.__reduce_ex__ and
+          cls.__reduce__ is object.__reduce__ and
+          getattr(cls, '__getstate__', None) is getattr(
+              object, '__getstate__', None) and
+          not hasattr(cls, '__setstate__') and
+          not hasattr(cls, '__getnewargs__') and
+          not hasattr(cls, '__getnewargs_ex__') and
+          cls not in copyreg.dispatch_table and
+          not any('__slots__' in vars(c) for c in cls.__mro__)):
+        plan = INSTANCE
+    else:
+        plan = FALLBACK
+    return _copy_plans.setdefault(cls, plan)
+
+
+def fast_deepcopy(obj, memo=None):
+    """Return a deep copy of obj, like copy.deepcopy(obj, memo)."""
+    if memo is None:
+        memo = {}
+    plans = _copy_plans
+    result = [None]
+    stack = [(obj, result, 0)]
+    push = stack.append
+    pop = stack.pop
+    while stack:
+        original, target, key = pop()
+        if original is _BUILD_TUPLE:
+            items, original = target
+            # a cycle back to the tuple, met while copying its items, may
+            # have built it already: use that copy, like copy.deepcopy
+            copied = memo.get(id(original), _MISSING)
+            if copied is _MISSING:
+                copied = memo[id(original)] = tuple(items)
+            key[0][key[1]] = copied
+            continue
+        cls = type(original)
+        plan = plans.get(cls)
+        if plan is None:
+            plan = copy_plan(cls)
+        if plan is ATOMIC:
+            target[key] = original
+            continue
+        copied = memo.get(id(original), _MISSING)
+        if copied is not _MISSING:
+            target[key] = copied
+            continue
+        if plan is LIST:
+            copied = original[:]
+            memo[id(original)] = target[key] = copied
+            for index, item in enumerate(original):
+                if plans.get(type(item)) is not ATOMIC:
+                    push((item, copied, index))
+        elif plan is DICT or plan is INSTANCE:
+            if plan is DICT:
+                copied = original.copy()
+                state, new_state = original, copied
+            else:
+                copied = cls.__new__(cls)
+                state, new_state = original.__dict__, copied.__dict__
+                new_state.update(state)
+            memo[id(original)] = target[key] = copied
+            for name, value in state.items():
+                if plans.get(type(value)) is not ATOMIC:
+                    push((value, new_state, name))
+        elif plan is TUPLE:
+            items = list(original)
+            deep = [index for index, item in enumerate(items)
+                    if plans.get(type(item)) is not ATOMIC]
+            if not deep:
+                target[key] = original
+                continue
+            # runs after all the items pushed below have been copied
+            push((_BUILD_TUPLE, (items, original), (target, key)))
+            for index in deep:
+                push((items[index], items, index))
+        elif plan is HOOK:
+            copied = original.__deepcopy__(memo)
+            memo[id(original)] = target[key] = copied
+        else:
+            target[key] = copy.deepcopy(original, memo)
+    return result[0]
+
+
+def benchmark_fast_deepcopy(number=5):
+    import timeit
+    objs = [UserDefinedObj('obj%d' % i) for i in range(10000)]
+    for i, udo in enumerate(objs):
+        # short chains, so copy.deepcopy stays within the recursion limit
+        udo.neighbour = objs[i - 1] if i % 50 else None
+        udo.info = {'id': i, 'tags': ('a', 'b'), 'scores': [1.0, 2.5]}
+    graph = {'objs': objs, 'first': objs[0]}
+    copied = fast_deepcopy(graph)
+    assert copied['first'] is copied['objs'][0]
+    assert copied['objs'][5].neighbour is copied['objs'][4]
+    assert copied['objs'][5].my_list is not objs[5].my_list
+    for func in (copy.deepcopy, fast_deepcopy):
+        seconds = timeit.timeit(lambda: func(graph), number=number) / number
+        print('%-14s %.3fs' % (func.__name__, seconds))
+
+    # far deeper than the recursion limit
+    deep = []
+    for i in range(100000):
+        deep = [deep, i]
+    try:
+        copy.deepcopy(deep)
+    except RecursionError:
+        print('copy.deepcopy: RecursionError')
+    print('fast_deepcopy: %d levels copied' % len(list(_levels(
+        fast_deepcopy(deep)))))
+
+
+def _levels(nested):
+    while nested:
+        yield nested[1]
+        nested = nested[0]
 
 
 if __name__ == "__main__":
     assign()
     shallow_copy()
     deep_copy()
+    benchmark_fast_deepcopy()
@@ -0,0 +1,414 @@
+"""Copying an Object Only When It Is Written To.
+
+Problem: you deep-copy objects defensively (see deep_copy in
+copy_object.py) so that the receiver can't change your data, but most
+receivers only ever read the copy. All that copying is wasted.
+
+Solution: hand out a copy-on-write proxy instead. cow(obj) wraps a dict, a
+list or a plain instance and shares the original until the first write.
+Reading an item that is itself a container gives a proxy for that container,
+created on demand. The first write through any proxy copies (shallowly)
+only the container being written, then makes sure its parent is a private
+copy too and points the parent's copy at the new child: this path copying
+goes up to the root, and every container off the path stays shared with the
+original. The original is never modified.
+
+cow_stats counts the proxies created and the copies actually made; every
+proxy that was never written to is a copy that deepcopy would have made for
+nothing.
+
+Values that are mutable but are neither dicts, lists nor plain instances
+(sets, bytearrays, tuples holding lists, ...) can't be watched: the first
+read deep-copies them into the proxy's private copy, so changes made to
+them stay in the copy. Immutable values are returned as they are.
+
+Caveats: calling a method of a wrapped instance deep-copies the instance
+first, since the method might change anything it refers to. Storing a proxy
+into another container stores its current value. unwrap() returns the
+current value, whose untouched parts are still the original's objects: read
+it, don't change it.
+"""
+from __future__ import print_function
+
+import copy
+import types
+
+
+class CowStats(object):
+    """Counters for copy-on-write proxies."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.proxies = 0
+        self.copies = 0
+
+    @property
+    def avoided(self):
+        """Containers reached through a proxy but never copied."""
+        return self.proxies - self.copies
+
+    def __repr__(self):
+        return 'CowStats(proxies=%d, copies=%d, avoided=%d)' % (
+            self.proxies, self.copies, self.avoided)
+
+
+cow_stats = CowStats()
+
+_NOT_INSTANCES = (type, types.ModuleType, types.FunctionType,
+                  types.BuiltinFunctionType, types.MethodType)
+_ATOMIC_TYPES = frozenset([int, float, complex, str, bytes, bool, type(None),
+                           range])
+
+
+def _is_immutable(value):
+    value_type = type(value)
+    if value_type in _ATOMIC_TYPES or isinstance(value, _NOT_INSTANCES):
+        return True
+    if value_type is tuple or value_type is frozenset:
+        return all(_is_immutable(item) for item in value)
+    return False
+
+
+def cow(obj):
+    """Return a copy-on-write proxy for obj: obj itself if it's immutable,
+    a deep copy of it if it's not a dict, list or plain instance."""
+    proxy = _wrap(obj, None, None)
+    if proxy is obj and not _is_immutable(obj):
+        cow_stats.copies += 1
+        return copy.deepcopy(obj)
+    return proxy
+
+
+def unwrap(obj):
+    """Return the value behind a proxy (obj itself if it isn't one)."""
+    if isinstance(obj, _CowProxy):
+        return object.__getattribute__(obj, '_target')
+    return obj
+
+
+def _wrap(value, parent, key):
+    value_type = type(value)
+    if value_type is dict:
+        proxy_type = CowDict
+    elif value_type is list:
+        proxy_type = CowList
+    elif hasattr(value, '__dict__') and not isinstance(value, _NOT_INSTANCES):
+        proxy_type = CowObject
+    else:
+        return value
+    proxy = object.__new__(proxy_type)
+    set_slot = object.__setattr__
+    set_slot(proxy, '_target', value)
+    set_slot(proxy, '_original', value)
+    set_slot(proxy, '_owned', False)
+    set_slot(proxy, '_parent', parent)
+    set_slot(proxy, '_key', key)
+    set_slot(proxy, '_children', {})
+    cow_stats.proxies += 1
+    return proxy
+
+
+class _CowProxy(object):
+    __slots__ = ('_target', '_original', '_owned', '_parent', '_key',
+                 '_children')
+
+    def _child(self, key, value):
+        """The proxy for the value found at key; a mutable value that
+        can't have one is replaced by a private deep copy first."""
+        child = self._children.get(key)
+        if child is not None:
+            if child is value:
+                # our private deep copy
+                return value
+            if isinstance(child, _CowProxy) and (child._target is value or
+                                                 child._original is value):
+                return child
+        if _is_immutable(value):
+            return value
+        child = _wrap(value, self, key)
+        if child is value:
+            self._materialize()
+            child = copy.deepcopy(value)
+            cow_stats.copies += 1
+            self._replace(key, value, child)
+        self._children[key] = child
+        return child
+
+    def _materialize(self):
+        """Make _target a private copy, path-copying the parents."""
+        if self._owned:
+            return
+        original = self._target
+        object.__setattr__(self, '_target', copy.copy(original))
+        object.__setattr__(self, '_owned', True)
+        cow_stats.copies += 1
+        parent = self._parent
+        if parent is not None:
+            parent._materialize()
+            parent._replace(self._key, original, self._target)
+
+    def _materialize_deep(self):
+        """Make _target a private deep copy, for code we can't watch."""
+        if self._owned == 'deep':
+            return
+        current = self._target
+        memo = {}
+        object.__setattr__(self, '_target', copy.deepcopy(current, memo))
+        object.__setattr__(self, '_owned', 'deep')
+        self._adopt_copies(memo)
+        cow_stats.copies += 1
+        parent = self._parent
+        if parent is not None:
+            parent._materialize()
+            parent._replace(self._key, current, self._target)
+
+    def _adopt_copies(self, memo):
+        """Point the child proxies at the copies deepcopy made of their
+        targets (memo maps ids to copies), which are private now."""
+        children = self._children
+        for key, child in list(children.items()):
+            if isinstance(child, _CowProxy):
+                target = memo.get(id(child._target))
+                if target is None:
+                    del children[key]
+                    continue
+                set_slot = object.__setattr__
+                set_slot(child, '_target', target)
+                set_slot(child, '_original', target)
+                set_slot(child, '_owned', 'deep')
+                child._adopt_copies(memo)
+            elif id(child) in memo:
+                children[key] = memo[id(child)]
+            else:
+                del children[key]
+
+    def unwrap(self):
+        return self._target
+
+    def __eq__(self, other):
+        return self._target == unwrap(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'cow(%r)' % (self._target,)
+
+
+class _CowContainer(_CowProxy):
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        value = self._target[key]
+        if type(value) in (int, float, str, bool, type(None)):
+            return value
+        return self._child(key, value)
+
+    def __len__(self):
+        return len(self._target)
+
+    def __contains__(self, item):
+        return unwrap(item) in self._target
+
+    def __setitem__(self, key, value):
+        self._materialize()
+        self._target[key] = unwrap(value)
+        self._children.pop(key, None)
+
+    def __delitem__(self, key):
+        self._materialize()
+        del self._target[key]
+        self._children.clear()
+
+    def clear(self):
+        self._materialize()
+        self._target.clear()
+        self._children.clear()
+
+    def pop(self, *args):
+        self._materialize()
+        self._children.clear()
+        # the popped value may still be shared with the original
+        return cow(self._target.pop(*args))
+
+
+class CowDict(_CowContainer):
+    __slots__ = ()
+
+    def _replace(self, key, old, new):
+        if self._target.get(key) is old:
+            self._target[key] = new
+
+    def get(self, key, default=None):
+        return self[key] if key in self._target else default
+
+    def __iter__(self):
+        return iter(self._target)
+
+    def keys(self):
+        return self._target.keys()
+
+    def values(self):
+        return [self[key] for key in self._target]
+
+    def items(self):
+        return [(key, self[key]) for key in self._target]
+
+    def popitem(self):
+        self._materialize()
+        self._children.clear()
+        key, value = self._target.popitem()
+        return key, cow(value)
+
+    def setdefault(self, key, default=None):
+        if key not in self._target:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        self._materialize()
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+
+class CowList(_CowContainer):
+    __slots__ = ()
+
+    def _replace(self, key, old, new):
+        target = self._target
+        if not (key < len(target) and target[key] is old):
+            # items moved since the child proxy was made: find it again
+            for key, item in enumerate(target):
+                if item is old:
+                    break
+            else:
+                return
+        target[key] = new
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            # a new, independent list sharing the items
+            return cow(self._target[key])
+        if key < 0:
+            key += len(self._target)
+        return _CowContainer.__getitem__(self, key)
+
+    def __setitem__(self, key, value):
+        if isinstance(key, slice):
+            self._materialize()
+            self._target[key] = [unwrap(item) for item in value]
+            self._children.clear()
+            return
+        if key < 0:
+            key += len(self._target)
+        _CowContainer.__setitem__(self, key, value)
+
+    def __iter__(self):
+        for index in range(len(self._target)):
+            yield self[index]
+
+    def index(self, item, *args):
+        return self._target.index(unwrap(item), *args)
+
+    def count(self, item):
+        return self._target.count(unwrap(item))
+
+    def append(self, item):
+        self._materialize()
+        self._target.append(unwrap(item))
+
+    def extend(self, items):
+        self._materialize()
+        self._target.extend(unwrap(item) for item in items)
+
+    def __iadd__(self, items):
+        self.extend(items)
+        return self
+
+    def insert(self, index, item):
+        self._materialize()
+        self._target.insert(index, unwrap(item))
+        self._children.clear()
+
+    def remove(self, item):
+        self._materialize()
+        self._target.remove(unwrap(item))
+        self._children.clear()
+
+    def sort(self, *args, **kwargs):
+        self._materialize()
+        self._target.sort(*args, **kwargs)
+        self._children.clear()
+
+    def reverse(self):
+        self._materialize()
+        self._target.reverse()
+        self._children.clear()
+
+
+class CowObject(_CowProxy):
+    __slots__ = ()
+
+    def _replace(self, key, old, new):
+        state = self._target.__dict__
+        if state.get(key) is old:
+            state[key] = new
+
+    def __getattr__(self, name):
+        target = self._target
+        if name not in target.__dict__ and callable(
+                getattr(type(target), name, None)):
+            # a method may change anything the instance refers to: give it
+            # a private deep copy
+            self._materialize_deep()
+            return getattr(self._target, name)
+        return self._child(name, getattr(target, name))
+
+    def __setattr__(self, name, value):
+        self._materialize()
+        setattr(self._target, name, unwrap(value))
+        self._children.pop(name, None)
+
+    def __delattr__(self, name):
+        self._materialize()
+        delattr(self._target, name)
+        self._children.pop(name, None)
+
+
+if __name__ == "__main__":
+    import timeit
+
+    class Account(object):
+        def __init__(self, number):
+            self.number = number
+            self.history = [{'amount': i, 'tags': ['x', 'y']}
+                            for i in range(100)]
+
+    accounts = {'acc%d' % i: Account(i) for i in range(1000)}
+
+    proxy = cow(accounts)
+    proxy['acc7'].history[3]['amount'] = -1
+    print(proxy['acc7'].history[3]['amount'],
+          accounts['acc7'].history[3]['amount'])
+    # only the path to the change was copied, the rest is still shared
+    print(unwrap(proxy)['acc8'] is accounts['acc8'],
+          unwrap(proxy)['acc7'].history[4] is accounts['acc7'].history[4])
+    print(cow_stats)
+
+    def read_mostly(copier):
+        data = copier(accounts)
+        total = sum(data['acc%d' % i].history[0]['amount']
+                    for i in range(0, 1000, 10))
+        data['acc1'].history[1]['amount'] = 0
+        return total
+
+    cow_stats.reset()
+    print('deepcopy: %.4fs' % timeit.timeit(
+        lambda: read_mostly(copy.deepcopy), number=1))
+    print('cow:      %.4fs' % timeit.timeit(
+        lambda: read_mostly(cow), number=1))
+    print(cow_stats)
@@ -0,0 +1,229 @@
+"""Flattening a Nested JSON Document Without Loading It.
+
+Problem: flatten and flatten_iteratively (see flatten_nested_sequence.py) need
+the whole nested object in memory, but your input is a JSON file of many
+gigabytes, e.g. a huge array of arrays. You want the leaves one at a time.
+Solution: read the file in chunks and turn the text into a stream of parse
+events ('start_array', 'end_array', 'start_map', 'map_key', 'end_map',
+'value'), the way SAX does for XML. Flattening the event stream is then the
+same explicit-stack technique used by flatten_iteratively, except that the
+stack holds only the path to the current position in the document, never the
+document itself.
+
+The standard library's json module has no incremental parser, but it does
+expose the two hard pieces: json.decoder.scanstring decodes a string literal
+(escapes included) and a regular expression covers numbers. When a token is
+cut in two by the end of a chunk, we read the next chunk and try again.
+
+Only a token that really runs into the end of the chunk is worth reading
+more for: anything else wrong with it is an error right away, without
+reading the rest of the file. So before decoding a string, STRING_BODY_RE
+finds where it ends, stopping early at anything that can't be part of a
+string (a bad escape, a control character). If it stops at the end of the
+chunk, or inside an escape the chunk cuts, we refill and resume the search
+where it stopped, rather than from the opening quote, so a long string
+costs one pass however many chunks it spans. Only a whole string goes to
+scanstring.
+"""
+from __future__ import print_function
+
+import json
+import re
+from json.decoder import scanstring
+
+NUMBER_RE = re.compile(r'-?(?:0|[1-9]\d*)(\.\d+)?([eE][-+]?\d+)?')
+WHITESPACE_RE = re.compile(r'[ \t\n\r]*')
+SCALAR_RE = re.compile(r'[-+.\w]*')
+CONSTANTS = {'true': True, 'false': False, 'null': None}
+# the characters and escapes a string may contain, up to the closing quote
+STRING_BODY_RE = re.compile(
+    r'[^"\\\x00-\x1f]*(?:\\(?:["\\/bfnrt]|u[0-9a-fA-F]{4})'
+    r'[^"\\\x00-\x1f]*)*')
+# an escape cut by the end of the chunk
+PARTIAL_ESCAPE_RE = re.compile(r'\\(?:u[0-9a-fA-F]{0,3})?\Z')
+
+
+def iter_json_events(fileobj, chunk_size=64 * 1024):
+    """Yield (event, value) pairs parsed incrementally from a text file."""
+    buf = fileobj.read(chunk_size)
+    eof = not buf
+    pos = 0
+    # one entry per open container: True for an object, False for an array
+    containers = []
+    # what the grammar allows next: 'value', 'key', or 'separator'
+    expect = 'value'
+    just_opened = False
+    # how far past pos the string starting at pos was already searched
+    scanned = 0
+    while True:
+        pos = WHITESPACE_RE.match(buf, pos).end()
+        if pos == len(buf):
+            if eof:
+                break
+            buf, pos, eof = _refill(fileobj, buf, pos, chunk_size)
+            continue
+        char = buf[pos]
+        if expect == 'separator':
+            if not containers:
+                raise ValueError('extra data after the top-level value')
+            if char == ',':
+                pos += 1
+                expect = 'key' if containers[-1] else 'value'
+                continue
+            if char not in ']}':
+                raise ValueError('expected , or closing bracket at %r' %
+                                 buf[pos:pos + 20])
+        if char == ']' or char == '}':
+            if not (expect == 'separator' or just_opened) or (
+                    containers[-1] != (char == '}')):
+                raise ValueError('unexpected %r' % char)
+            containers.pop()
+            pos += 1
+            expect = 'separator'
+            just_opened = False
+            yield ('end_map' if char == '}' else 'end_array'), None
+            continue
+        just_opened = False
+        if expect == 'key':
+            if char != '"':
+                raise ValueError('expected object key at %r' %
+                                 buf[pos:pos + 20])
+            stop = _string_stop(buf, pos, scanned, eof)
+            if stop is not None:
+                scanned = stop - pos
+                buf, pos, eof = _refill(fileobj, buf, pos, chunk_size)
+                continue
+            key, end = scanstring(buf, pos + 1)
+            colon = WHITESPACE_RE.match(buf, end).end()
+            if colon == len(buf) and not eof:
+                scanned = end - 1 - pos
+                buf, pos, eof = _refill(fileobj, buf, pos, chunk_size)
+                continue
+            scanned = 0
+            if colon == len(buf):
+                raise ValueError('unexpected end of JSON input')
+            if buf[colon] != ':':
+                raise ValueError('expected : after object key %r' % key)
+            pos = colon + 1
+            expect = 'value'
+            yield 'map_key', key
+            continue
+        # a value
+        if char == '[' or char == '{':
+            containers.append(char == '{')
+            pos += 1
+            expect = 'key' if char == '{' else 'value'
+            # the container may be empty and close right away
+            just_opened = True
+            yield ('start_map' if char == '{' else 'start_array'), None
+            continue
+        if char == '"':
+            stop = _string_stop(buf, pos, scanned, eof)
+            if stop is not None:
+                scanned = stop - pos
+                buf, pos, eof = _refill(fileobj, buf, pos, chunk_size)
+                continue
+            scanned = 0
+            value, end = scanstring(buf, pos + 1)
+        else:
+            # numbers and true/false/null: find where the token ends first, as
+            # one running into the end of the chunk may continue in the next
+            end = SCALAR_RE.match(buf, pos).end()
+            if end == len(buf) and not eof:
+                buf, pos, eof = _refill(fileobj, buf, pos, chunk_size)
+                continue
+            token = buf[pos:end]
+            match = NUMBER_RE.match(token)
+            if match is not None and match.end() == len(token):
+                if match.group(1) or match.group(2):
+                    value = float(token)
+                else:
+                    value = int(token)
+            elif token in CONSTANTS:
+                value = CONSTANTS[token]
+            else:
+                raise ValueError('invalid JSON value at %r' %
+                                 buf[pos:pos + 20])
+        pos = end
+        expect = 'separator'
+        yield 'value', value
+    if containers or expect != 'separator':
+        raise ValueError('unexpected end of JSON input')
+
+
+def _string_stop(buf, start, scanned, eof):
+    """For the string whose opening quote is at start, return None if buf
+    holds all of it (or all we'll ever get), else the position to resume
+    searching for its end from once more text is read."""
+    stop = STRING_BODY_RE.match(buf, max(start + 1, start + scanned)).end()
+    if eof or (stop < len(buf) and buf[stop] == '"'):
+        return None
+    if stop == len(buf) or PARTIAL_ESCAPE_RE.match(buf, stop):
+        return stop
+    # a bad escape or control character: scanstring says what's wrong
+    return None
+
+
+def _refill(fileobj, buf, pos, chunk_size):
+    """Drop the consumed part of buf and append the next chunk.
+
+    A token longer than chunk_size is carried over from refill to refill:
+    reading at least as much as is carried over doubles the buffer each
+    time, so the copying stays linear in the token's length.
+    """
+    kept = buf[pos:]
+    chunk = fileobj.read(max(chunk_size, len(kept)))
+    return kept + chunk, 0, not chunk
+
+
+def flatten_json_stream(fileobj, with_path=False, chunk_size=64 * 1024):
+    """Yield the leaves of the JSON document in fileobj, in document order.
+
+    Arrays and objects are both expanded. With with_path=True each leaf comes
+    as (path, value), where path is a tuple of array indices and object keys.
+    Memory use is bounded by the chunk size plus the nesting depth.
+    """
+    # path to the current position; the last entry is updated in place as
+    # we move through the items of the innermost container
+    path = []
+    # True for objects, False for arrays, parallel to path
+    in_map = []
+    for event, value in iter_json_events(fileobj, chunk_size):
+        if event == 'map_key':
+            path[-1] = value
+            continue
+        if event == 'end_array' or event == 'end_map':
+            path.pop()
+            in_map.pop()
+            continue
+        if path and not in_map[-1]:
+            path[-1] += 1
+        if event == 'value':
+            if with_path:
+                yield tuple(path), value
+            else:
+                yield value
+        else:
+            # start_array / start_map
+            in_map.append(event == 'start_map')
+            path.append(None if event == 'start_map' else -1)
+
+
+if __name__ == "__main__":
+    import io
+    import tempfile
+
+    document = [[1, 2, [3, 4.5]], {"a": "xé", "b": [True, None]}, [], 6]
+    with tempfile.TemporaryFile('w+') as f:
+        json.dump(document, f)
+        f.seek(0)
+        # a tiny chunk size to show that tokens split across chunks are fine
+        print(list(flatten_json_stream(f, chunk_size=3)))
+        f.seek(0)
+        for path, value in flatten_json_stream(f, with_path=True):
+            print(path, value)
+
+    # the leaves of a large array of arrays, without building the lists
+    text = io.StringIO('[' + ','.join('[%d, %d]' % (i, i * i)
+                                      for i in range(100000)) + ']')
+    print(sum(flatten_json_stream(text)))
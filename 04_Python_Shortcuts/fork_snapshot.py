@@ -0,0 +1,196 @@
+"""Persisting a Consistent Snapshot of Live State with fork().
+
+Problem: to save a consistent picture of a big in-memory state, you take a
+lock and deep-copy it (see copy_object.py) or serialize it while holding
+the lock, and everything waiting on that lock stalls for seconds.
+
+Solution: on POSIX systems, os.fork() gives you the copy for free. The child
+process starts with an identical view of the parent's memory, and the
+kernel only copies a page when one of the two processes writes to it. So:
+take the lock, fork, release the lock. The parent goes back to work after
+microseconds, while the child serializes the frozen state at its own pace,
+reports progress through a pipe and exits.
+
+Forking a threaded process needs care, because only the forking thread
+exists in the child. A lock held by another thread at the moment of the
+fork is held forever in the child, and state that thread was halfway
+through changing stays half-changed. register_fork_lock(lock) lists the
+locks that guard your state: they are acquired just before every fork
+(through os.register_at_fork) and released in both processes just after, so
+the fork always happens between two changes and the child inherits free
+locks. They must be RLocks: the thread that forks may already hold one
+(as in "take the lock, fork"), and acquiring a plain Lock again would
+block it forever. The child also disables the garbage collector (a collection would
+touch, and therefore copy, every page of the state), does nothing but
+write the file, and leaves with os._exit so that no atexit handler or
+inherited buffer runs twice.
+"""
+from __future__ import print_function
+
+import gc
+import os
+import pickle
+import threading
+
+_fork_locks = []
+_plain_lock_type = type(threading.Lock())
+
+
+def register_fork_lock(lock):
+    """Hold lock, a threading.RLock, across every fork, so no fork happens
+    while another thread has it."""
+    if isinstance(lock, _plain_lock_type):
+        raise TypeError('register a threading.RLock: a thread forking while '
+                        'it holds a plain Lock would deadlock on it')
+    _fork_locks.append(lock)
+
+
+def _acquire_fork_locks():
+    for lock in _fork_locks:
+        lock.acquire()
+
+
+def _release_fork_locks():
+    for lock in reversed(_fork_locks):
+        lock.release()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(before=_acquire_fork_locks,
+                        after_in_parent=_release_fork_locks,
+                        after_in_child=_release_fork_locks)
+
+
+class _ProgressWriter(object):
+    """File wrapper that reports the bytes written every so often."""
+
+    def __init__(self, fileobj, fd, every):
+        self.fileobj = fileobj
+        self.fd = fd
+        self.every = every
+        self.written = 0
+        self._next_report = every
+
+    def write(self, data):
+        self.fileobj.write(data)
+        self.written += len(data)
+        if self.written >= self._next_report:
+            _send(self.fd, 'progress', self.written)
+            self._next_report = self.written + self.every
+        return len(data)
+
+
+def _send(fd, kind, value):
+    os.write(fd, ('%s %s\n' % (kind, value)).encode('utf-8'))
+
+
+class SnapshotJob(object):
+    """A snapshot being written by a child process."""
+
+    def __init__(self, pid, path, on_progress, on_done):
+        self.pid = pid
+        self.path = path
+        self.bytes_written = 0
+        self.ok = None
+        self.error = None
+        self._on_progress = on_progress
+        self._on_done = on_done
+        self._finished = threading.Event()
+
+    def _watch(self, read_fd):
+        """Runs in a thread of the parent until the child exits."""
+        with os.fdopen(read_fd, 'rb') as messages:
+            for line in messages:
+                kind, _, value = line.decode('utf-8').rstrip('\n').partition(' ')
+                if kind == 'progress' or kind == 'done':
+                    self.bytes_written = int(value)
+                    if kind == 'progress' and self._on_progress is not None:
+                        self._on_progress(self)
+                elif kind == 'error':
+                    self.error = value
+        _, status = os.waitpid(self.pid, 0)
+        code = os.waitstatus_to_exitcode(status)
+        self.ok = code == 0 and self.error is None
+        if not self.ok and self.error is None:
+            if code < 0:
+                self.error = 'snapshot process killed by signal %d' % -code
+            else:
+                self.error = 'snapshot process exited with code %d' % code
+        self._finished.set()
+        if self._on_done is not None:
+            self._on_done(self)
+
+    def wait(self, timeout=None):
+        """Wait for the snapshot to finish; return True if it was saved."""
+        self._finished.wait(timeout)
+        return bool(self.ok)
+
+
+def fork_snapshot(state, path, dump=pickle.dump, on_progress=None,
+                  on_done=None, progress_every=1024 * 1024):
+    """Write state to path from a forked child and return a SnapshotJob.
+
+    dump(state, fileobj) does the serializing (pickle.dump by default). The
+    file is written under a temporary name and renamed when complete, so
+    path only ever holds a whole snapshot. on_progress(job) and
+    on_done(job) are called from a watcher thread in the parent.
+    """
+    if not hasattr(os, 'fork'):
+        raise OSError('fork snapshots need os.fork (POSIX)')
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # the child: only this thread exists here
+        code = 1
+        temp_path = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            os.close(read_fd)
+            gc.disable()
+            with open(temp_path, 'wb') as f:
+                writer = _ProgressWriter(f, write_fd, progress_every)
+                dump(state, writer)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, path)
+            _send(write_fd, 'done', writer.written)
+            code = 0
+        except BaseException as e:
+            try:
+                _send(write_fd, 'error', repr(e).replace('\n', ' '))
+                os.remove(temp_path)
+            except BaseException:
+                pass
+        finally:
+            os._exit(code)
+    os.close(write_fd)
+    job = SnapshotJob(pid, path, on_progress, on_done)
+    watcher = threading.Thread(target=job._watch, args=(read_fd,))
+    watcher.daemon = True
+    watcher.start()
+    return job
+
+
+if __name__ == "__main__":
+    import tempfile
+    import time
+
+    state_lock = threading.RLock()
+    register_fork_lock(state_lock)
+    state = {'counter': 0, 'rows': [list(range(100)) for _ in range(50000)]}
+
+    def report(job):
+        print('  %s: %d bytes so far' % (job.path, job.bytes_written))
+
+    path = os.path.join(tempfile.mkdtemp(), 'state.pickle')
+    started = time.time()
+    job = fork_snapshot(state, path, on_progress=report,
+                        progress_every=8 * 1024 * 1024)
+    print('parent free again after %.4fs' % (time.time() - started))
+    # keep changing the state: the snapshot is not affected
+    while not job.wait(0.01):
+        with state_lock:
+            state['counter'] += 1
+    print('saved=%s, %d bytes, %.2fs, %d changes made meanwhile' % (
+        job.ok, job.bytes_written, time.time() - started, state['counter']))
+    with open(path, 'rb') as f:
+        print('counter in the snapshot:', pickle.load(f)['counter'])
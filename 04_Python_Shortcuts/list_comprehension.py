@@ -20,24 +20,31 @@ In Python 2.4, you should consider using a generator expression,
 rather than a list comprehension, when the sequence may be long and you only
 need one item at a time.
 """
+from __future__ import print_function
+
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from timeit import default_timer
 
 
 def list_comprehension():
     old_list = [1, 2, 3, 4, 5, 6, 7, 8]
-    print old_list
+    print(old_list)
 
     # create a new list by adding 23 to each item of some other list.
     new_list1 = [x + 23 for x in old_list]
-    print new_list1
+    print(new_list1)
 
     # create the new list to comprise all items in the other list that are
     # larger than 5
     new_list2 = [x for x in old_list if x > 5]
-    print new_list2
+    print(new_list2)
 
     # combine both ideas of new_list1 and new_list2
     new_list3 = [x + 23 for x in old_list if x > 5]
-    print new_list3
+    print(new_list3)
 
     # if your task is to set all items greater than 100 to 100,
     # in an existing list object L, the best solution is:
@@ -46,7 +53,7 @@ def list_comprehension():
     # !!! Assigning to the "whole-list slice" L[:] alters the existing list
     # object in place, rather than just rebinding the name L, as would be the
     # case if you coded L = . . . instead.
-    print L
+    print(L)
 
 
 def generator_expression():
@@ -67,9 +74,222 @@ def generator_expression():
     """
     theoldlist = [1, 2, 3, 4, 5, 6, 7, 8]
     total = sum(x + 23 for x in theoldlist if x > 5)
-    print total
+    print(total)
+
+
+"""Fusing Chains of Generator Expressions.
+
+A chain of generator expressions, one per map or filter step:
+    a = (f(x) for x in source)
+    b = (y for y in a if p(y))
+    total = sum(g(z) for z in b)
+never materializes a list, but every item still travels through one
+generator frame per stage, and resuming a generator costs about as much as
+a function call. Pipeline records the stages instead of nesting generators,
+and runs them all in the body of a single loop compiled for that sequence
+of stages, so each item costs one loop iteration plus the calls to your own
+functions:
+    total = Pipeline(source).map(f).filter(p).map(g).sum()
+
+When the functions themselves are expensive, .parallel() runs the fused
+stages on chunks of the source in a process pool (the functions must then
+be picklable, i.e. defined at module level, not lambdas), and .profile()
+reports how much time each stage takes.
+"""
+
+# (stage kinds, terminal) -> compiled loop function
+_fused_loops = {}
+
+
+def _fused_loop(kinds, terminal):
+    """Compile a function running the given stages over every item.
+
+    terminal says what happens to an item that comes out of the last stage:
+    'yield' makes a generator, 'list' collects the items, 'sum' and 'count'
+    return the sum or the number of items.
+    """
+    key = (kinds, terminal)
+    try:
+        return _fused_loops[key]
+    except KeyError:
+        pass
+    names = ['f%d' % i for i in range(len(kinds))]
+    lines = ['def fused(source, start, %s):' % ''.join(n + ', ' for n in names)]
+    if terminal == 'list':
+        lines += ['    result = []', '    append = result.append']
+    elif terminal in ('sum', 'count'):
+        lines.append('    result = start')
+    lines.append('    for x in source:')
+    for name, kind in zip(names, kinds):
+        if kind == 'map':
+            lines.append('        x = %s(x)' % name)
+        else:
+            lines.append('        if not %s(x):' % name)
+            lines.append('            continue')
+    lines.append({
+        'yield': '        yield x',
+        'list': '        append(x)',
+        'sum': '        result += x',
+        'count': '        result += 1',
+    }[terminal])
+    if terminal != 'yield':
+        lines.append('    return result')
+    namespace = {}
+    exec('\n'.join(lines) + '\n', namespace)
+    return _fused_loops.setdefault(key, namespace['fused'])
+
+
+def _run_chunk(kinds, funcs, terminal, chunk):
+    """Run the fused stages over one chunk (in a worker process)."""
+    if terminal == 'sum':
+        # the chunk's sum can't start from 0, which the caller's start (a
+        # tuple, a list...) may not add to: start from the first item, and
+        # return [] for a chunk with no items left
+        items = _fused_loop(kinds, 'yield')(chunk, None, *funcs)
+        for first in items:
+            return [_fused_loop((), 'sum')(items, first)]
+        return []
+    return _fused_loop(kinds, terminal)(chunk, 0, *funcs)
+
+
+class Pipeline(object):
+    """A lazy chain of map/filter stages over an iterable, fused into one
+    loop when a terminal operation (iteration, to_list, sum, count) runs."""
+
+    def __init__(self, source):
+        self.source = source
+        self.stages = ()
+        self.processes = None
+        self.chunk_size = None
+
+    def _with(self, **changes):
+        pipeline = Pipeline(self.source)
+        pipeline.__dict__.update(self.__dict__)
+        pipeline.__dict__.update(changes)
+        return pipeline
+
+    def map(self, func):
+        return self._with(stages=self.stages + (('map', func),))
+
+    def filter(self, predicate):
+        return self._with(stages=self.stages + (('filter', predicate),))
+
+    def parallel(self, processes=None, chunk_size=10000):
+        """Run the stages on chunks of chunk_size items in a process pool."""
+        return self._with(processes=processes or 0, chunk_size=chunk_size)
+
+    def _run(self, terminal, start=0):
+        kinds = tuple(kind for kind, func in self.stages)
+        funcs = [func for kind, func in self.stages]
+        if self.chunk_size is None:
+            return _fused_loop(kinds, terminal)(self.source, start, *funcs)
+        results = self._run_parallel(kinds, funcs, terminal)
+        if terminal == 'yield':
+            return (item for chunk in results for item in chunk)
+        if terminal == 'list':
+            return [item for chunk in results for item in chunk]
+        if terminal == 'sum':
+            partials = (partial for chunk in results for partial in chunk)
+            return _fused_loop((), 'sum')(partials, start)
+        return sum(results, start)
+
+    def _run_parallel(self, kinds, funcs, terminal):
+        """Yield the chunk results in order, keeping only a few chunks in
+        flight so that the source is not read all at once."""
+        if terminal == 'yield':
+            terminal = 'list'
+        processes = self.processes or os.cpu_count() or 1
+        items = iter(self.source)
+        with ProcessPoolExecutor(processes) as pool:
+            pending = deque()
+            limit = 2 * processes
+            while True:
+                while len(pending) < limit:
+                    chunk = list(islice(items, self.chunk_size))
+                    if not chunk:
+                        break
+                    pending.append(pool.submit(
+                        _run_chunk, kinds, funcs, terminal, chunk))
+                if not pending:
+                    return
+                yield pending.popleft().result()
+
+    def __iter__(self):
+        return iter(self._run('yield'))
+
+    def to_list(self):
+        return self._run('list')
+
+    def sum(self, start=0):
+        return self._run('sum', start)
+
+    def count(self):
+        return self._run('count')
+
+    def profile(self, chunk_size=10000):
+        """Run the pipeline one stage at a time on chunks of the source and
+        return (list of results, per-stage report).
+
+        Each report entry is (stage, seconds, items in, items out). Running
+        a stage over a whole chunk with map/filter keeps the timer calls out
+        of the per-item loop, so the numbers are not swamped by the cost of
+        measuring them.
+        """
+        stats = [[0.0, 0, 0] for stage in self.stages]
+        result = []
+        items = iter(self.source)
+        while True:
+            chunk = list(islice(items, chunk_size))
+            if not chunk:
+                break
+            for (kind, func), stat in zip(self.stages, stats):
+                stat[1] += len(chunk)
+                started = default_timer()
+                chunk = list((map if kind == 'map' else filter)(func, chunk))
+                stat[0] += default_timer() - started
+                stat[2] += len(chunk)
+            result.extend(chunk)
+        report = [('%s(%s)' % (kind, getattr(func, '__name__', func)),) +
+                  tuple(stat) for (kind, func), stat in zip(self.stages, stats)]
+        return result, report
+
+
+def _double(x):
+    return x * 2
+
+
+def _add_23(x):
+    return x + 23
+
+
+def _greater_than_5(x):
+    return x > 5
+
+
+def _slow_square(x):
+    return sum(x * x for i in range(200)) // 200
+
+
+def pipeline_example():
+    import timeit
+    theoldlist = list(range(1000000))
+    chained = lambda: sum(_add_23(z) for z in (
+        y for y in (_double(x) for x in theoldlist) if _greater_than_5(y)))
+    fused = lambda: Pipeline(theoldlist).map(_double).filter(
+        _greater_than_5).map(_add_23).sum()
+    assert chained() == fused()
+    print('chained generators: %.3fs' % timeit.timeit(chained, number=1))
+    print('fused pipeline:     %.3fs' % timeit.timeit(fused, number=1))
+
+    pipeline = Pipeline(range(20000)).map(_slow_square).filter(_greater_than_5)
+    print('sequential: %.3fs' % timeit.timeit(pipeline.sum, number=1))
+    print('parallel:   %.3fs' % timeit.timeit(
+        pipeline.parallel(chunk_size=2000).sum, number=1))
+    for stage, seconds, items_in, items_out in pipeline.profile()[1]:
+        print('%-25s %.3fs %d -> %d' % (stage, seconds, items_in, items_out))
 
 
 if __name__ == "__main__":
     list_comprehension()
     generator_expression()
+    pipeline_example()
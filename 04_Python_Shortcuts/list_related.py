@@ -1,6 +1,9 @@
 """List related."""
 from __future__ import print_function
 
+from array import array
+from operator import itemgetter
+
 
 def list_get(L, i, default_value=None):
     """Returning an Element of a List If It Exists.
@@ -37,6 +40,161 @@ def list_get_for_more_correct_cases(L, i, default_value=None):
         return default_value
 
 
+def list_get_many(L, indices, default_value=None):
+    """Returning the Elements of a List at Many Indices, with a Default.
+
+    Calling list_get once per index in a tight loop pays a Python function
+    call per index. When the same list is read at many indices at once,
+    it is much cheaper to do all the lookups in one go:
+    - if L is a NumPy array, the valid indices are found with a vectorized
+    mask and fetched with a single take along the first axis (so for a 2-D
+    array, rows are returned), everything else is the default;
+    - otherwise min() and max() check in one C-level pass each whether every
+    index is valid, which is the common case, and a single
+    operator.itemgetter fetches them all; only when some index is out of
+    range do we fall back to checking indices one by one.
+    A list is returned, or an array if L is an array. The array's dtype
+    must hold both L's items and default_value: with the default None, it's
+    an object array, so pass a default of L's kind (0, float('nan'), ...)
+    to get a numeric one.
+    """
+    numpy = _numpy_if_array(L)
+    if numpy is not None:
+        indices = numpy.asarray(indices, dtype=numpy.intp)
+        size = len(L)
+        valid = (indices >= -size) & (indices < size)
+        dtype = numpy.result_type(L.dtype, numpy.asarray(default_value).dtype)
+        result = numpy.full(indices.shape + L.shape[1:], default_value,
+                             dtype=dtype)
+        result[valid] = L.take(indices[valid], axis=0)
+        return result
+    if not isinstance(indices, (list, tuple)):
+        indices = list(indices)
+    size = len(L)
+    if len(indices) > 1 and -size <= min(indices) and max(indices) < size:
+        return list(itemgetter(*indices)(L))
+    return [L[i] if -size <= i < size else default_value for i in indices]
+
+
+def _numpy_if_array(obj):
+    """Return the numpy module if obj is a NumPy array, without importing it
+    when it has never been imported (then obj can't be an array)."""
+    import sys
+    numpy = sys.modules.get('numpy')
+    if numpy is not None and isinstance(obj, numpy.ndarray):
+        return numpy
+    return None
+
+
+class AdaptiveListGetter(object):
+    """list_get that picks LBYL or EGFP from the hit rate it observes.
+
+    Which of list_get and list_get_for_more_correct_cases is faster depends
+    only on how often the index is out of range, and that changes from one
+    workload to the next. An AdaptiveListGetter counts misses over a window
+    of calls and, at the end of each window, rebinds self.get to the bounds
+    checking version if misses are frequent, or to the try/except version if
+    almost every index is valid (the same "switch the method on the
+    instance" trick as RingBufferAlternative). The only bookkeeping on a hit
+    is one countdown per call.
+
+    On CPython 3.11, where a try block costs nothing until it catches,
+    benchmark_list_get puts the break-even point at about one miss in five
+    (80% hits), hence the default max_miss_rate of 0.2; older interpreters
+    want a lower one.
+    """
+
+    def __init__(self, window=1000, max_miss_rate=0.2):
+        self.window = window
+        self.max_miss_rate = max_miss_rate
+        # calls and misses of the windows completed so far, by path
+        self.lbyl_calls = self.eafp_calls = 0
+        self.misses = 0
+        self.switches = 0
+        self._countdown = window
+        self._window_misses = 0
+        self.get = self._lbyl_get
+
+    def _lbyl_get(self, L, i, default_value=None):
+        self._countdown -= 1
+        if not self._countdown:
+            self._adapt()
+        if -len(L) <= i < len(L):
+            return L[i]
+        self._window_misses += 1
+        return default_value
+
+    def _eafp_get(self, L, i, default_value=None):
+        self._countdown -= 1
+        if not self._countdown:
+            self._adapt()
+        try:
+            return L[i]
+        except IndexError:
+            self._window_misses += 1
+            return default_value
+
+    def _adapt(self):
+        """End of a window: book its counts and choose the path for the next
+        one."""
+        if self.get == self._lbyl_get:
+            self.lbyl_calls += self.window
+        else:
+            self.eafp_calls += self.window
+        self.misses += self._window_misses
+        if self._window_misses <= self.max_miss_rate * self.window:
+            get = self._eafp_get
+        else:
+            get = self._lbyl_get
+        if get != self.get:
+            self.get = get
+            self.switches += 1
+        self._countdown = self.window
+        self._window_misses = 0
+
+    def counters(self):
+        """Return the call/miss counts so far, including the current window."""
+        partial = self.window - self._countdown
+        lbyl = self.get == self._lbyl_get
+        calls = self.lbyl_calls + self.eafp_calls + partial
+        misses = self.misses + self._window_misses
+        return {
+            'lbyl_calls': self.lbyl_calls + (partial if lbyl else 0),
+            'eafp_calls': self.eafp_calls + (0 if lbyl else partial),
+            'hits': calls - misses,
+            'misses': misses,
+            'switches': self.switches,
+            'current': 'lbyl' if lbyl else 'eafp',
+        }
+
+
+def benchmark_list_get(calls=200000):
+    """Time list_get, list_get_for_more_correct_cases and AdaptiveListGetter
+    on hit rates from 0% to 100%."""
+    import random
+    import timeit
+    L = list(range(1000))
+    print('hit rate   list_get   EGFP       adaptive   (adaptive paths)')
+    for percent in range(0, 101, 10):
+        hits = calls * percent // 100
+        indices = ([random.randrange(len(L)) for _ in range(hits)] +
+                   [len(L) + i for i in range(calls - hits)])
+        random.shuffle(indices)
+        adaptive = AdaptiveListGetter()
+        timings = [
+            timeit.timeit(lambda: [list_get(L, i) for i in indices],
+                          number=1),
+            timeit.timeit(lambda: [list_get_for_more_correct_cases(L, i)
+                                   for i in indices], number=1),
+            timeit.timeit(lambda: [adaptive.get(L, i) for i in indices],
+                          number=1),
+        ]
+        counters = adaptive.counters()
+        print('%4d%%     %8.3fs  %8.3fs  %8.3fs  lbyl=%d eafp=%d' % (
+            (percent,) + tuple(timings) +
+            (counters['lbyl_calls'], counters['eafp_calls'])))
+
+
 def loop_with_indexes(L):
     """Looping over Items and Their Indices in a Sequence.
 
@@ -101,6 +259,147 @@ def create_list_without_sharing_reference():
     print(multilist)
 
 
+class Grid(object):
+    """A rows x cols grid of numbers stored in one contiguous array.array.
+
+    The list comprehension above gives every row its own list, which avoids
+    sharing but costs a list header per row plus one pointer and one boxed
+    number per cell. At 10k x 10k that is gigabytes. A Grid keeps the cells,
+    row after row, in a single array.array of machine numbers: one word per
+    cell with the default typecode 'd', less with a smaller typecode such as
+    'i' or 'f', and nothing is shared because nothing is referenced.
+
+    grid[r, c] reads or writes a cell, grid[r0:r1, c0:c1] copies a block
+    into a new Grid, and assigning a number to a block fills it in place.
+    row() and column() return memoryviews that write through to the grid.
+    """
+    __slots__ = ('rows', 'cols', 'data')
+
+    def __init__(self, rows, cols, fill=0, typecode='d'):
+        self.rows = rows
+        self.cols = cols
+        # repeating a one-item array allocates all the cells in one go
+        self.data = array(typecode, [fill]) * (rows * cols)
+
+    def _offset(self, r, c):
+        if r < 0:
+            r += self.rows
+        if c < 0:
+            c += self.cols
+        if not (0 <= r < self.rows and 0 <= c < self.cols):
+            raise IndexError('Grid index out of range')
+        return r * self.cols + c
+
+    def _row_index(self, r):
+        if r < 0:
+            r += self.rows
+        if not 0 <= r < self.rows:
+            raise IndexError('Grid row out of range')
+        return r
+
+    def _block(self, key):
+        """The range of rows and the column slice addressed by a key."""
+        r, c = key
+        if isinstance(r, slice):
+            row_range = range(*r.indices(self.rows))
+        else:
+            r = self._row_index(r)
+            row_range = range(r, r + 1)
+        if isinstance(c, slice):
+            col_range = range(*c.indices(self.cols))
+        else:
+            c = self._offset(0, c)
+            col_range = range(c, c + 1)
+        # the same columns as a slice of a row view (a negative step may
+        # have to run past index 0, which only None can say)
+        if not col_range:
+            return row_range, slice(0, 0)
+        stop = col_range.stop if col_range.stop >= 0 else None
+        return row_range, slice(col_range.start, stop, col_range.step)
+
+    def __getitem__(self, key):
+        r, c = key
+        if not isinstance(r, slice) and not isinstance(c, slice):
+            return self.data[self._offset(r, c)]
+        row_range, col_slice = self._block(key)
+        cols = len(range(*col_slice.indices(self.cols)))
+        block = Grid(len(row_range), cols, typecode=self.data.typecode)
+        view = memoryview(self.data)
+        target = memoryview(block.data)
+        for i, row in enumerate(row_range):
+            start = row * self.cols
+            target[i * cols:(i + 1) * cols] = (
+                view[start:start + self.cols][col_slice])
+        return block
+
+    def __setitem__(self, key, value):
+        r, c = key
+        if not isinstance(r, slice) and not isinstance(c, slice):
+            self.data[self._offset(r, c)] = value
+            return
+        row_range, col_slice = self._block(key)
+        view = memoryview(self.data)
+        for i, row in enumerate(row_range):
+            start = row * self.cols
+            target = view[start:start + self.cols][col_slice]
+            if isinstance(value, Grid):
+                target[:] = value.row(i)
+            else:
+                _fill_view(target, value)
+
+    def row(self, r):
+        """A writable view of row r."""
+        start = self._row_index(r) * self.cols
+        return memoryview(self.data)[start:start + self.cols]
+
+    def column(self, c):
+        """A writable (strided) view of column c."""
+        return memoryview(self.data)[self._offset(0, c)::self.cols]
+
+    def fill(self, value):
+        """Set every cell to value, in place."""
+        _fill_view(memoryview(self.data), value)
+
+    def __len__(self):
+        return self.rows
+
+    def __iter__(self):
+        for r in range(self.rows):
+            yield self.row(r)
+
+    @property
+    def nbytes(self):
+        return self.data.itemsize * len(self.data)
+
+    def tolist(self):
+        """Return the cells as a list of lists."""
+        return [self.row(r).tolist() for r in range(self.rows)]
+
+    def to_numpy(self):
+        """A NumPy array sharing the grid's memory (no copy)."""
+        import numpy
+        return numpy.frombuffer(self.data, dtype=self.data.typecode).reshape(
+            self.rows, self.cols)
+
+    def __repr__(self):
+        return 'Grid(%d, %d, typecode=%r)' % (self.rows, self.cols,
+                                              self.data.typecode)
+
+
+def _fill_view(view, value):
+    """Fill a memoryview with value by repeatedly doubling the filled part,
+    so the work is done by a handful of C-level copies."""
+    size = len(view)
+    if not size:
+        return
+    view[0] = value
+    filled = 1
+    while filled < size:
+        count = min(filled, size - filled)
+        view[filled:filled + count] = view[:count]
+        filled += count
+
+
 if __name__ == "__main__":
     L = [1, 2, 3, 4, 5, 6, 7, 8]
     for i in range(15):
@@ -109,6 +408,16 @@ if __name__ == "__main__":
               (list_get(L, i), list_get_for_more_correct_cases(L, i)),
               end=" ")
     print("")
+    print(list_get_many(L, range(-10, 10), 'x'))
+    benchmark_list_get()
+
+    grid = Grid(3, 5)
+    grid[0, 0] = 7
+    # a single array of 15 doubles, no row shares anything with another
+    print(grid, grid.nbytes, grid.tolist())
+    grid[1:, 2:4] = 1
+    grid.column(4)[:] = array('d', [9, 9, 9])
+    print(grid.tolist())
 
     loop_with_indexes(L)
     print(L)
@@ -0,0 +1,196 @@
+"""Flattening Nested Records into Columns.
+
+Problem: your data is a stream of nested dictionaries (events, JSON documents)
+and you need it as flat columns for analysis, one column per leaf, named by
+the dotted path to it: {'user': {'id': 1}} becomes the column 'user.id'.
+flatten (see flatten_nested_sequence.py) would lose the keys, so we need a
+walk that remembers them.
+
+Solution: walk the first record with an explicit stack, the same recursion
+removal used by flatten_iteratively, to find its leaf paths: that is the
+schema. Most streams are dominated by records of one shape, so instead of
+walking every record we compile the schema into a small function that pulls
+all the leaves out with plain subscripts and checks, by comparing dict sizes,
+that the record has no keys the schema doesn't know about. Records that don't
+fit take the slow path, which walks them and adds any new columns.
+
+Rows are buffered as tuples and turned into columns once per chunk with
+zip(*rows), so the transposition runs at C speed, and memory stays bounded by
+the chunk size however long the stream is. Lists are leaves, as in
+pandas.json_normalize. Two paths that would make the same column name (a
+key 'a.b' next to {'a': {'b': ...}}) raise ValueError: pick another sep.
+"""
+from __future__ import print_function
+
+from itertools import zip_longest
+
+
+class _SchemaMismatch(Exception):
+    pass
+
+
+def record_paths(record):
+    """Yield (path, value) for every leaf of a nested dict, in key order."""
+    stack = [((), iter(record.items()))]
+    while stack:
+        prefix, items = stack[-1]
+        for key, value in items:
+            path = prefix + (key,)
+            if type(value) is dict and value:
+                stack.append((path, iter(value.items())))
+                break
+            yield path, value
+        else:
+            stack.pop()
+
+
+def compile_extractor(paths):
+    """Build a function returning the values at paths as one tuple.
+
+    It raises _SchemaMismatch (or KeyError/TypeError) for a record that
+    doesn't have exactly the dict keys implied by paths.
+    """
+    namespace = {'_SchemaMismatch': _SchemaMismatch}
+    # sub-dict path -> (variable name, number of keys)
+    nodes = {(): ['r', 0]}
+    lines = []
+    leaves = []
+    for path in paths:
+        for depth in range(1, len(path)):
+            prefix = path[:depth]
+            if prefix not in nodes:
+                parent = nodes[prefix[:-1]]
+                parent[1] += 1
+                name = '_%d' % len(nodes)
+                key = 'k%d' % len(namespace)
+                namespace[key] = prefix[-1]
+                lines.append('    %s = %s[%s]' % (name, parent[0], key))
+                nodes[prefix] = [name, 0]
+        parent = nodes[path[:-1]]
+        parent[1] += 1
+        key = 'k%d' % len(namespace)
+        namespace[key] = path[-1]
+        leaves.append('%s[%s]' % (parent[0], key))
+    checks = ['len(%s) != %d' % (name, size) for name, size in nodes.values()]
+    source = 'def extract(r):\n'
+    source += '\n'.join(lines) + '\n' if lines else ''
+    source += '    if %s:\n' % ' or '.join(checks)
+    source += '        raise _SchemaMismatch\n'
+    source += '    return (%s)\n' % ''.join(leaf + ', ' for leaf in leaves)
+    exec(source, namespace)
+    return namespace['extract']
+
+
+class RecordNormalizer(object):
+    """Turn an iterable of nested dicts into chunks of dotted-path columns."""
+
+    def __init__(self, sep='.', chunk_size=10000):
+        self.sep = sep
+        self.chunk_size = chunk_size
+        self.paths = []
+        self._path_index = {}
+        # column name -> path, to catch two paths joined into one name
+        self._names = {}
+        self._extract = None
+        # how many records took each path, to see if the schema fits
+        self.fast_records = 0
+        self.slow_records = 0
+
+    @property
+    def columns(self):
+        return [self.sep.join(map(str, path)) for path in self.paths]
+
+    def normalize(self, records):
+        """Yield {column name: list of values} for every chunk of records."""
+        rows = []
+        for record in records:
+            row = None
+            if self._extract is not None:
+                try:
+                    row = self._extract(record)
+                except (_SchemaMismatch, LookupError, TypeError):
+                    pass
+                else:
+                    if dict in map(type, row):
+                        # a leaf turned into a sub-dict
+                        row = None
+            if row is None:
+                row = self._slow_row(record)
+                self.slow_records += 1
+            else:
+                self.fast_records += 1
+            rows.append(row)
+            if len(rows) >= self.chunk_size:
+                yield self._columns(rows)
+                rows = []
+        if rows:
+            yield self._columns(rows)
+
+    def _slow_row(self, record):
+        values = [None] * len(self.paths)
+        for path, value in record_paths(record):
+            try:
+                values[self._path_index[path]] = value
+            except KeyError:
+                self._add_path(path)
+                values.append(value)
+        if self._extract is None:
+            # the first record fixes the shape of the fast path
+            self._extract = compile_extractor(self.paths)
+        return tuple(values)
+
+    def _add_path(self, path):
+        name = self.sep.join(map(str, path))
+        other = self._names.get(name)
+        if other is not None:
+            raise ValueError('paths %r and %r both make the column %r' %
+                             (other, path, name))
+        self._names[name] = path
+        self._path_index[path] = len(self.paths)
+        self.paths.append(path)
+
+    def _columns(self, rows):
+        names = self.columns
+        if set(map(len, rows)) == set([len(names)]):
+            columns = list(zip(*rows))
+        else:
+            # rows built before a new column appeared are shorter: pad them
+            columns = list(zip_longest(*rows))
+        result = {}
+        for position, name in enumerate(names):
+            if position < len(columns):
+                result[name] = list(columns[position])
+            else:
+                # a column that no row of this chunk reaches at all
+                result[name] = [None] * len(rows)
+        return result
+
+
+def normalize_records(records, sep='.', chunk_size=10000):
+    """Yield chunks of columns, see RecordNormalizer.normalize."""
+    return RecordNormalizer(sep, chunk_size).normalize(records)
+
+
+if __name__ == "__main__":
+    import timeit
+
+    events = [
+        {'id': i, 'user': {'name': 'u%d' % i, 'geo': {'lat': 1.5, 'lon': 2}},
+         'tags': ['a', 'b']}
+        for i in range(100000)]
+    events[3] = {'id': 3, 'user': {'name': 'u3'}, 'extra': True}
+
+    normalizer = RecordNormalizer(chunk_size=4)
+    first = next(normalizer.normalize(events))
+    for name in normalizer.columns:
+        print(name, first[name])
+
+    def slow_only():
+        rows = [dict(record_paths(event)) for event in events]
+        return rows
+
+    def normalized():
+        return list(normalize_records(events))
+
+    print('walk every record: %.3fs' % timeit.timeit(slow_only, number=1))
+    print('normalize_records: %.3fs' % timeit.timeit(normalized, number=1))
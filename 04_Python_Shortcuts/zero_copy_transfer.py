@@ -0,0 +1,219 @@
+"""Handing Large Objects to Another Process Without Copying Them.
+
+Problem: you pass objects (see copy_object.py) to multiprocessing workers,
+and some of them carry big binary payloads: bytes, arrays, images. Sending
+them through a Queue or Pipe pickles each payload into the stream (one
+copy), pushes the stream through the pipe (two more, through the kernel)
+and unpickles it into a fresh object (another one).
+
+Solution: pickle protocol 5 (Python 3.8+, PEP 574) can leave large buffers
+out of the pickle stream: pickle.dumps hands each PickleBuffer to a
+buffer_callback, and pickle.loads takes the buffers back as an argument.
+dump_shared puts those buffers side by side in one
+multiprocessing.shared_memory block, so the only copy left is the one into
+shared memory, and sends a small SharedPickle envelope instead: the
+in-band pickle plus the name of the block and where each buffer lives in
+it. load_shared attaches to the block and unpickles with memoryviews of it,
+so the receiver's objects are backed by the shared memory itself.
+
+NumPy arrays support out-of-band buffers out of the box. bytes and
+bytearray don't (bytes always pickle in-band, a bytearray is copied when it
+is rebuilt), so wrap such payloads in OutOfBand.
+
+The receiver owns the block: dump_shared takes it off the sender's
+resource tracker (which would otherwise unlink it, with a "leaked
+shared_memory" warning, when the sender exits, even if the receiver hasn't
+attached yet), and load_shared unlinks its name right away (the mapping
+stays valid until closed) and returns the SharedMemory handle with the
+object. Drop every reference to the object before handle.close(), or
+close() raises BufferError because the memory is still in use. Nothing
+frees the block of an envelope that is never loaded: it stays in the
+system until reboot, so pass envelopes you give up on (a send that failed,
+a worker that died) to discard_shared.
+"""
+from __future__ import print_function
+
+import pickle
+from multiprocessing import resource_tracker, shared_memory
+
+# buffers smaller than this stay in the pickle stream
+MIN_OUT_OF_BAND = 64 * 1024
+ALIGNMENT = 64
+
+
+class OutOfBand(object):
+    """A bytes-like payload pickled out-of-band at protocol 5 and rebuilt
+    as a memoryview of the received buffer, without a copy."""
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __reduce_ex__(self, protocol):
+        if protocol >= 5:
+            return _rebuild_out_of_band, (pickle.PickleBuffer(self.data),)
+        return _rebuild_out_of_band, (bytes(self.data),)
+
+    def __len__(self):
+        return memoryview(self.data).nbytes
+
+
+def _rebuild_out_of_band(buf):
+    return OutOfBand(memoryview(buf))
+
+
+class SharedPickle(object):
+    """The small, picklable part of an object sent with dump_shared."""
+    __slots__ = ('data', 'shm_name', 'spans')
+
+    def __init__(self, data, shm_name, spans):
+        self.data = data
+        self.shm_name = shm_name
+        self.spans = spans
+
+    def __getstate__(self):
+        return self.data, self.shm_name, self.spans
+
+    def __setstate__(self, state):
+        self.data, self.shm_name, self.spans = state
+
+
+def dump_shared(obj, min_size=MIN_OUT_OF_BAND):
+    """Pickle obj, moving buffers of min_size bytes or more into shared
+    memory, and return the SharedPickle to send."""
+    buffers = []
+
+    def out_of_band(buf):
+        try:
+            raw = buf.raw()
+        except BufferError:
+            # not contiguous: let pickle copy it in-band
+            return True
+        if raw.nbytes < min_size:
+            return True
+        buffers.append(raw)
+        return False
+
+    data = pickle.dumps(obj, protocol=5, buffer_callback=out_of_band)
+    if not buffers:
+        return SharedPickle(data, None, ())
+    spans = []
+    offset = 0
+    for raw in buffers:
+        spans.append((offset, raw.nbytes))
+        offset += -(-raw.nbytes // ALIGNMENT) * ALIGNMENT
+    shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+    try:
+        for raw, (start, size) in zip(buffers, spans):
+            shm.buf[start:start + size] = raw
+    except BaseException:
+        shm.close()
+        shm.unlink()
+        raise
+    shm.close()
+    # the receiver owns the block now: don't let our tracker unlink it
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    return SharedPickle(data, shm.name, tuple(spans))
+
+
+def load_shared(envelope):
+    """Return (obj, shared memory handle) for a SharedPickle.
+
+    The handle is None when everything was sent in-band.
+    """
+    if envelope.shm_name is None:
+        return pickle.loads(envelope.data), None
+    shm = shared_memory.SharedMemory(name=envelope.shm_name)
+    # nobody else needs the name; the memory lives on until shm.close()
+    shm.unlink()
+    views = [shm.buf[start:start + size] for start, size in envelope.spans]
+    try:
+        return pickle.loads(envelope.data, buffers=views), shm
+    finally:
+        # the loaded objects hold their own views of what they use
+        for view in views:
+            view.release()
+
+
+def discard_shared(envelope):
+    """Free the shared memory of a SharedPickle that won't be loaded."""
+    if envelope.shm_name is None:
+        return
+    try:
+        shm = shared_memory.SharedMemory(name=envelope.shm_name)
+    except FileNotFoundError:
+        return
+    shm.close()
+    shm.unlink()
+
+
+def _receiver(conn):
+    """Worker: receive payloads, touch every page, reply with the size."""
+    while True:
+        message = conn.recv()
+        if message is None:
+            break
+        if isinstance(message, SharedPickle):
+            obj, shm = load_shared(message)
+            payload = obj.data
+        else:
+            obj, shm = message, None
+            payload = obj
+        view = memoryview(payload)
+        size = view.nbytes
+        checksum = sum(view[::4096])
+        view.release()
+        del obj, payload, view
+        if shm is not None:
+            shm.close()
+        conn.send((size, checksum))
+
+
+def benchmark_transfer(max_size=64 * 1024 * 1024, repeat=3):
+    """Throughput of plain pickling vs. dump_shared for 1 KB .. max_size."""
+    import multiprocessing
+    import timeit
+    parent, child = multiprocessing.Pipe()
+    worker = multiprocessing.Process(target=_receiver, args=(child,))
+    worker.start()
+    try:
+        size = 1024
+        print('%12s %14s %14s' % ('size', 'pickle MB/s', 'shared MB/s'))
+        while size <= max_size:
+            payload = bytes(bytearray(range(256)) * (size // 256))
+
+            def plain():
+                parent.send(payload)
+                return parent.recv()
+
+            def shared():
+                parent.send(dump_shared(OutOfBand(payload)))
+                return parent.recv()
+
+            assert plain() == shared()
+            rates = []
+            for send in (plain, shared):
+                seconds = min(timeit.repeat(send, number=1, repeat=repeat))
+                rates.append(size / seconds / 1e6)
+            print('%12d %14.1f %14.1f' % ((size,) + tuple(rates)))
+            size *= 16
+    finally:
+        parent.send(None)
+        worker.join()
+
+
+if __name__ == "__main__":
+    import sys
+
+    envelope = dump_shared({'name': 'frame', 'pixels': OutOfBand(
+        bytes(1024 * 1024))})
+    # the envelope is tiny, the megabyte went to shared memory
+    print(len(pickle.dumps(envelope)), envelope.spans)
+    obj, shm = load_shared(envelope)
+    print(obj['name'], len(obj['pixels']))
+    del obj
+    shm.close()
+
+    # pass e.g. 1073741824 to go up to 1 GB
+    benchmark_transfer(int(sys.argv[1]) if len(sys.argv) > 1 else
+                       64 * 1024 * 1024)
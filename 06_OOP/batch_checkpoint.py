@@ -0,0 +1,200 @@
+"""Saving the Changed Instances of a Large Collection in One Batch.
+
+Problem: instance_snapshot.py lets you save only the instances modified
+since the last save, but the obvious save loop:
+    for obj in instances:
+        if obj.is_changed():
+            save(obj)
+            obj.snapshot()
+checks, serializes and writes one instance at a time. With millions of
+instances, the checks and the pickling keep one core busy, and writing
+each instance in a transaction of its own makes the disk wait on itself.
+
+Solution: checkpoint() splits the work in phases and does each in bulk:
+1. scan: worker processes check chunks of the collection and pickle the
+   state of the changed instances. The workers are forked after the
+   collection is stored in a module global, so they inherit it (copy on
+   write) instead of receiving it through a pipe; only the pickled states
+   of changed instances travel back.
+2. write: the parent inserts the rows each chunk sends back with one
+   executemany per chunk, all in a single SQLite transaction.
+3. commit: one commit, one sync to disk.
+4. snapshot: once the rows are safely stored, the parent snapshots the
+   changed instances. This must happen in the parent: a snapshot taken in
+   a worker would vanish with it.
+CheckpointStats reports the time spent in each phase and the throughput.
+Where fork() is not available, or the collection is small, the scan runs
+in the calling process.
+
+Don't change the instances while a checkpoint runs: the workers see the
+collection as it was when they were forked.
+"""
+from __future__ import print_function
+
+import os
+import pickle
+import sqlite3
+from timeit import default_timer
+
+# (instances, key function) while a checkpoint runs, inherited by the
+# forked workers
+_job = None
+
+
+def _saved_state(obj):
+    """The state of obj worth saving: its __dict__ minus change tracking."""
+    state = obj.__dict__.copy()
+    state.pop('_snapshot', None)
+    state.pop('_digests', None)
+    state.pop('_dirty_flag', None)
+    return state
+
+
+def _scan_chunk(bounds):
+    """Return (rows, indices) for the changed instances in one chunk."""
+    instances, key = _job
+    rows = []
+    indices = []
+    for index in range(*bounds):
+        obj = instances[index]
+        if obj.is_changed():
+            rows.append((index if key is None else key(obj),
+                         pickle.dumps((obj.__class__, _saved_state(obj)),
+                                      pickle.HIGHEST_PROTOCOL)))
+            indices.append(index)
+    return rows, indices
+
+
+class CheckpointStats(object):
+    """What a checkpoint did and where the time went."""
+
+    def __init__(self, scanned, workers):
+        self.scanned = scanned
+        self.workers = workers
+        self.saved = 0
+        self.bytes = 0
+        self.seconds = dict.fromkeys(('scan', 'write', 'commit', 'snapshot'),
+                                     0.0)
+
+    @property
+    def total_seconds(self):
+        return sum(self.seconds.values())
+
+    def __str__(self):
+        total = self.total_seconds or 1e-9
+        lines = ['%d instances scanned by %d worker(s), %d saved (%.1f MB) '
+                 'in %.3fs: %.0f instances/s' % (
+                     self.scanned, self.workers, self.saved, self.bytes / 1e6,
+                     total, self.scanned / total)]
+        for phase in ('scan', 'write', 'commit', 'snapshot'):
+            seconds = self.seconds[phase]
+            lines.append('  %-9s %.3fs (%4.1f%%)' % (
+                phase, seconds, 100.0 * seconds / total))
+        return '\n'.join(lines)
+
+
+def checkpoint(instances, db_path, key=None, processes=None,
+               chunk_size=10000, table='instances'):
+    """Save the changed instances to an SQLite file, snapshot them, and
+    return a CheckpointStats.
+
+    Rows are (key, pickled (class, state)): key(obj) if a key function is
+    given, else the instance's position in the collection.
+    """
+    global _job
+    if not hasattr(instances, '__getitem__'):
+        instances = list(instances)
+    count = len(instances)
+    chunks = [(start, min(start + chunk_size, count))
+              for start in range(0, count, chunk_size)]
+    processes = processes or os.cpu_count() or 1
+    if not hasattr(os, 'fork') or len(chunks) < 2:
+        processes = 1
+    stats = CheckpointStats(count, processes)
+    db = sqlite3.connect(db_path)
+    pool = None
+    _job = instances, key
+    try:
+        db.execute('CREATE TABLE IF NOT EXISTS %s '
+                   '(key PRIMARY KEY, state BLOB)' % table)
+        db.commit()
+        insert = 'INSERT OR REPLACE INTO %s VALUES (?, ?)' % table
+        started = default_timer()
+        if processes > 1:
+            import multiprocessing
+            pool = multiprocessing.get_context('fork').Pool(processes)
+            results = pool.imap_unordered(_scan_chunk, chunks)
+        else:
+            results = (_scan_chunk(bounds) for bounds in chunks)
+        changed = []
+        for rows, indices in results:
+            written = default_timer()
+            stats.seconds['scan'] += written - started
+            db.executemany(insert, rows)
+            stats.saved += len(rows)
+            stats.bytes += sum(len(state) for _, state in rows)
+            changed.extend(indices)
+            started = default_timer()
+            stats.seconds['write'] += started - written
+        db.commit()
+        committed = default_timer()
+        stats.seconds['commit'] = committed - started
+        for index in changed:
+            instances[index].snapshot()
+        stats.seconds['snapshot'] = default_timer() - committed
+    finally:
+        _job = None
+        if pool is not None:
+            pool.terminate()
+        db.close()
+    return stats
+
+
+def load_checkpoint(db_path, table='instances'):
+    """Yield (key, instance) for every instance saved in db_path.
+
+    The state goes through the class's __setstate__ if it has one (so a
+    DirtyTrackingMixin tracks its containers again), and the instances are
+    snapshotted: they match what is saved, so the next checkpoint skips
+    them until they change.
+    """
+    db = sqlite3.connect(db_path)
+    try:
+        for key, blob in db.execute('SELECT key, state FROM %s' % table):
+            cls, state = pickle.loads(blob)
+            obj = cls.__new__(cls)
+            if getattr(cls, '__setstate__', None) is not None:
+                obj.__setstate__(state)
+            else:
+                obj.__dict__.update(state)
+            take_snapshot = getattr(obj, 'snapshot', None)
+            if take_snapshot is not None:
+                take_snapshot()
+            yield key, obj
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    from instance_snapshot import ChangeCheckerMixin
+
+    class Account(ChangeCheckerMixin):
+        def __init__(self, number):
+            self.number = number
+            self.owner = 'owner%d' % number
+            self.history = [{'amount': i, 'tags': ['x', 'y']}
+                            for i in range(10)]
+
+    accounts = [Account(i) for i in range(200000)]
+    path = os.path.join(tempfile.mkdtemp(), 'accounts.db')
+    # the first checkpoint saves everything
+    print(checkpoint(accounts, path, key=lambda account: account.number))
+    for processes in (1, None):
+        for account in accounts[::100]:
+            account.history[0]['amount'] += 1
+        print(checkpoint(accounts, path, key=lambda account: account.number,
+                         processes=processes))
+    saved = dict(load_checkpoint(path))
+    print(len(saved), saved[100].history[0], accounts[100].is_changed())
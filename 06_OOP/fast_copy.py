@@ -40,6 +40,129 @@ class MyClass(object):
         # in the relevant subset of self's attributes, to set in newcopy
         return new_copy
 
+"""empty_copy works, but it creates a brand-new Empty class on every call,
+and a class is a big object: making one costs more than the copy itself and
+the discarded classes keep the garbage collector busy. There is no need for a
+subclass at all: cls.__new__(cls) gives an uninitialized instance without
+running __init__ (this is what the copy and pickle modules do).
+
+clone builds on that. What to do for each class is worked out once and
+cached in a CloneRule: how to allocate, whether there is a __dict__ to copy,
+which __slots__ to copy, and which fields need a per-field copy function
+instead of being shared. A class lists those in __clone_rules__, e.g.
+    __clone_rules__ = {'items': list, 'meta': copy.copy}
+so every clone gets its own items list. clone_many(proto, n) makes n clones
+in one call, paying the rule lookup once.
+"""
+
+
+class CloneRule(object):
+    """How to clone instances of one class."""
+    __slots__ = ('new', 'has_dict', 'slots', 'field_copiers')
+
+    def __init__(self, cls):
+        if cls.__new__ is object.__new__:
+            self.new = object.__new__
+        else:
+            self.new = cls.__new__
+        self.has_dict = any('__dict__' in vars(klass) for klass in cls.__mro__)
+        slots = []
+        field_copiers = {}
+        for klass in reversed(cls.__mro__):
+            names = vars(klass).get('__slots__', ())
+            if isinstance(names, str):
+                names = (names,)
+            for name in names:
+                if name in ('__dict__', '__weakref__'):
+                    continue
+                if name.startswith('__') and not name.endswith('__'):
+                    # a private slot is stored under its mangled name
+                    name = '_%s%s' % (klass.__name__.lstrip('_'), name)
+                slots.append(name)
+            field_copiers.update(vars(klass).get('__clone_rules__', {}))
+        self.slots = tuple(slots)
+        self.field_copiers = tuple(field_copiers.items())
+
+
+_clone_rules = {}
+
+
+def clone_rule(cls):
+    """Return (and cache) the CloneRule for cls."""
+    try:
+        return _clone_rules[cls]
+    except KeyError:
+        return _clone_rules.setdefault(cls, CloneRule(cls))
+
+
+def clone(proto):
+    """Return a copy of proto made without calling __init__."""
+    return clone_many(proto, 1)[0]
+
+
+def clone_many(proto, n):
+    """Return a list of n clones of proto."""
+    cls = type(proto)
+    try:
+        rule = _clone_rules[cls]
+    except KeyError:
+        rule = clone_rule(cls)
+    new = rule.new
+    clones = [new(cls) for _ in range(n)]
+    if rule.has_dict:
+        state = proto.__dict__
+        for obj in clones:
+            obj.__dict__.update(state)
+    for name in rule.slots:
+        try:
+            value = getattr(proto, name)
+        except AttributeError:
+            # an empty slot stays empty
+            continue
+        for obj in clones:
+            setattr(obj, name, value)
+    for name, copier in rule.field_copiers:
+        try:
+            value = getattr(proto, name)
+        except AttributeError:
+            continue
+        for obj in clones:
+            setattr(obj, name, copier(value))
+    return clones
+
+
+class Prototype(object):
+    """A class with a slow __init__ and state worth cloning."""
+    __clone_rules__ = {'items': list}
+
+    def __init__(self):
+        # assume there's a lot of work here
+        self.name = 'proto'
+        self.items = [1, 2, 3]
+        self.size = 3
+
+
+class SlottedPrototype(object):
+    __slots__ = ('x', 'y', '__private')
+
+    def __init__(self):
+        self.x = 1
+        self.y = [1]
+        self.__private = 'p'
+
+
+def benchmark_clone(n=100000):
+    import timeit
+    mc = MyClass()
+    mc.name = 'proto'
+    mc.items = [1, 2, 3]
+    for label, func in [
+            ('MyClass.__copy__', lambda: [mc.__copy__() for _ in range(n)]),
+            ('clone', lambda: [clone(mc) for _ in range(n)]),
+            ('clone_many', lambda: clone_many(mc, n))]:
+        print('%-17s %.3fs' % (label, timeit.timeit(func, number=1)))
+
+
 if __name__ == "__main__":
     import copy
     # does run __init__
@@ -49,3 +172,11 @@ if __name__ == "__main__":
     mc_copy = copy.copy(mc)
     mc_copy.my_print()
     print(mc_copy)
+
+    proto = Prototype()
+    twin = clone(proto)
+    # items is copied per clone, the rest is shared
+    print(twin.name, twin.items, twin.items is proto.items)
+    slotted = clone(SlottedPrototype())
+    print(slotted.x, slotted.y, slotted._SlottedPrototype__private)
+    benchmark_clone()
@@ -0,0 +1,280 @@
+"""Looking Records Up by Field Without Scanning Them All.
+
+Problem: you keep super_tuple records (see named_tuple.py) in a list and
+select them with comprehensions like
+    [r for r in records if r.city == 'Paris']
+many times per second. Each of these visits every record.
+
+Solution: keep the records in a Table that maintains indexes on the fields
+you select on, the way a database does. Records get a row id (rid): their
+position in the table's list of rows. Two kinds of indexes map field values
+to rids:
+- a hash index is a dict from each value to the set of rids holding it:
+  lookup(field, value) is O(1) (plus the size of the answer);
+- a sorted index is two parallel lists, the values in sorted order and
+  their rids, searched with bisect: lookup is O(log n), and so is finding
+  where range(field, low, high) starts and ends.
+Indexes are kept up to date on every insert and delete, so they never have
+to be rebuilt; insert_many() and building an index sort all the new items
+at once. Inserting into a sorted index shifts the end of its lists
+(a memmove of pointers, fast for lists of millions of items); use it for
+fields queried by range, and hash indexes for equality.
+
+Deleting a record leaves a tombstone (None) in its row, so the other rids
+stay valid; compact() drops the tombstones, renumbering the rows.
+index_memory() tells what each index costs.
+"""
+from __future__ import print_function
+
+import sys
+from bisect import bisect_left, bisect_right
+
+
+class _HashIndex(object):
+    __slots__ = ('position', 'rids_by_value')
+
+    def __init__(self, position):
+        self.position = position
+        self.rids_by_value = {}
+
+    def add(self, value, rid):
+        rids = self.rids_by_value.get(value)
+        if rids is None:
+            self.rids_by_value[value] = {rid}
+        else:
+            rids.add(rid)
+
+    def add_many(self, pairs):
+        for value, rid in pairs:
+            self.add(value, rid)
+
+    def remove(self, value, rid):
+        rids = self.rids_by_value[value]
+        rids.discard(rid)
+        if not rids:
+            del self.rids_by_value[value]
+
+    def rids(self, value):
+        return self.rids_by_value.get(value, ())
+
+    def memory(self):
+        return sys.getsizeof(self.rids_by_value) + sum(
+            map(sys.getsizeof, self.rids_by_value.values()))
+
+
+class _SortedIndex(object):
+    """Values in sorted order, and their rids; among equal values, rids
+    are in increasing order."""
+    __slots__ = ('position', 'keys', 'rids_list')
+
+    def __init__(self, position):
+        self.position = position
+        self.keys = []
+        self.rids_list = []
+
+    def add(self, value, rid):
+        keys = self.keys
+        low = bisect_left(keys, value)
+        high = bisect_right(keys, value, low)
+        at = bisect_left(self.rids_list, rid, low, high)
+        keys.insert(at, value)
+        self.rids_list.insert(at, rid)
+
+    def add_many(self, pairs):
+        pairs = list(pairs)
+        if len(pairs) < 64:
+            for value, rid in pairs:
+                self.add(value, rid)
+            return
+        # one sort instead of many inserts; the old items are already a
+        # sorted run, which the sort merges with the new ones
+        merged = sorted(list(zip(self.keys, self.rids_list)) + pairs)
+        self.keys = [value for value, rid in merged]
+        self.rids_list = [rid for value, rid in merged]
+
+    def remove(self, value, rid):
+        low = bisect_left(self.keys, value)
+        high = bisect_right(self.keys, value, low)
+        at = bisect_left(self.rids_list, rid, low, high)
+        if at == high or self.rids_list[at] != rid:
+            raise KeyError((value, rid))
+        del self.keys[at]
+        del self.rids_list[at]
+
+    def rids(self, value):
+        low = bisect_left(self.keys, value)
+        return self.rids_list[low:bisect_right(self.keys, value, low)]
+
+    def range(self, low, high):
+        start = 0 if low is None else bisect_left(self.keys, low)
+        stop = (len(self.keys) if high is None else
+                bisect_left(self.keys, high, start))
+        return self.rids_list[start:stop]
+
+    def memory(self):
+        return sys.getsizeof(self.keys) + sys.getsizeof(self.rids_list)
+
+
+class Table(object):
+    """Records of one schema, with optional hash and sorted indexes."""
+
+    def __init__(self, schema, records=()):
+        self.schema = schema
+        self.rows = []
+        self._live = 0
+        self._positions = dict((name, position) for position, name
+                               in enumerate(schema._fields))
+        self._indexes = {}
+        self.insert_many(records)
+
+    def _add_index(self, field, index_type):
+        if field in self._indexes:
+            raise ValueError('%s is already indexed' % field)
+        index = index_type(self._positions[field])
+        position = index.position
+        index.add_many((record[position], rid)
+                       for rid, record in enumerate(self.rows)
+                       if record is not None)
+        self._indexes[field] = index
+
+    def add_hash_index(self, field):
+        """Index field for O(1) lookup()."""
+        self._add_index(field, _HashIndex)
+
+    def add_sorted_index(self, field):
+        """Index field for O(log n) lookup() and range()."""
+        self._add_index(field, _SortedIndex)
+
+    def drop_index(self, field):
+        del self._indexes[field]
+
+    def insert(self, record):
+        """Add a record and return its rid."""
+        rid = len(self.rows)
+        self.rows.append(record)
+        self._live += 1
+        for index in self._indexes.values():
+            index.add(record[index.position], rid)
+        return rid
+
+    def insert_many(self, records):
+        """Add records and return their rids; the indexes are updated in
+        bulk."""
+        records = list(records)
+        start = len(self.rows)
+        self.rows.extend(records)
+        self._live += len(records)
+        rids = range(start, len(self.rows))
+        for index in self._indexes.values():
+            position = index.position
+            index.add_many([(record[position], rid)
+                            for record, rid in zip(records, rids)])
+        return list(rids)
+
+    def delete(self, rid):
+        """Remove the record at rid (its rid is not reused)."""
+        record = self.rows[rid]
+        if record is None:
+            raise KeyError(rid)
+        for index in self._indexes.values():
+            index.remove(record[index.position], rid)
+        self.rows[rid] = None
+        self._live -= 1
+
+    def __getitem__(self, rid):
+        record = self.rows[rid]
+        if record is None:
+            raise KeyError(rid)
+        return record
+
+    def __len__(self):
+        return self._live
+
+    def __iter__(self):
+        for record in self.rows:
+            if record is not None:
+                yield record
+
+    def _records(self, rids):
+        rows = self.rows
+        return [rows[rid] for rid in sorted(rids)]
+
+    def lookup_rids(self, field, value):
+        """The rids of the records whose field equals value."""
+        index = self._indexes.get(field)
+        if index is not None:
+            return index.rids(value)
+        position = self._positions[field]
+        return [rid for rid, record in enumerate(self.rows)
+                if record is not None and record[position] == value]
+
+    def lookup(self, field, value):
+        """The records whose field equals value, in rid order."""
+        return self._records(self.lookup_rids(field, value))
+
+    def where(self, **conditions):
+        """The records whose fields equal all the given values."""
+        rid_sets = sorted((set(self.lookup_rids(field, value))
+                           for field, value in conditions.items()), key=len)
+        if not rid_sets:
+            return list(self)
+        return self._records(rid_sets[0].intersection(*rid_sets[1:]))
+
+    def range(self, field, low=None, high=None):
+        """The records with low <= field < high (None: no bound), in the
+        order of field."""
+        index = self._indexes.get(field)
+        rows = self.rows
+        if isinstance(index, _SortedIndex):
+            return [rows[rid] for rid in index.range(low, high)]
+        position = self._positions[field]
+        found = [record for record in rows if record is not None and
+                 (low is None or record[position] >= low) and
+                 (high is None or record[position] < high)]
+        found.sort(key=lambda record: record[position])
+        return found
+
+    def compact(self):
+        """Drop the tombstones left by deletions; this changes the rids."""
+        self.rows = [record for record in self.rows if record is not None]
+        indexes = self._indexes
+        self._indexes = {}
+        for field, index in indexes.items():
+            self._add_index(field, type(index))
+
+    def index_memory(self):
+        """Bytes used by each index's own containers (the values and rids
+        in them are shared with the records)."""
+        return dict((field, index.memory())
+                    for field, index in self._indexes.items())
+
+
+if __name__ == "__main__":
+    import timeit
+
+    from named_tuple import super_tuple
+
+    Person = super_tuple('Person', 'id', 'city', 'age')
+    cities = ['city%d' % i for i in range(1000)]
+    people = Person.make_many([(i, cities[i % 1000], i % 97)
+                               for i in range(1000000)])
+    table = Table(Person, people)
+    table.add_hash_index('city')
+    table.add_sorted_index('age')
+
+    print(len(table.lookup('city', 'city7')), len(table.range('age', 30, 33)),
+          len(table.where(city='city7', age=7)))
+    print('scan   city == x:  %.5fs' % timeit.timeit(
+        lambda: [p for p in people if p.city == 'city7'], number=1))
+    print('lookup city == x:  %.5fs' % timeit.timeit(
+        lambda: table.lookup('city', 'city7'), number=1))
+    print('scan   30 <= age < 33: %.5fs' % timeit.timeit(
+        lambda: [p for p in people if 30 <= p.age < 33], number=1))
+    print('range  30 <= age < 33: %.5fs' % timeit.timeit(
+        lambda: table.range('age', 30, 33), number=1))
+
+    rid = table.insert(Person(-1, 'city7', 30))
+    table.delete(3)
+    print(table[rid], len(table.lookup('city', 'city7')), len(table))
+    for field, size in sorted(table.index_memory().items()):
+        print('index on %-5s %6.1f MB' % (field, size / 1e6))
@@ -8,11 +8,18 @@ inherit from and that is able to take snapshots of an instance's state and
 compare the instance's current state with the last snapshot to determine
 whether or not the instance has been modified
 """
+from __future__ import print_function
+
 import copy
+import functools
+import hashlib
+import pickle
+import struct
 
 
 class ChangeCheckerMixin(object):
-    container_items = {dict: dict.iteritems, list: enumerate}
+    container_items = {dict: getattr(dict, 'iteritems', dict.items),
+                       list: enumerate}
     """ As container types, ChangeCheckerMixin, as presented,
     considers only list and dict. If you also use other types as containers,
     you just need to add them appropriately to the containerItems dictionary.
@@ -41,6 +48,8 @@ class ChangeCheckerMixin(object):
         if self.immutable:
             return
         else:
+            # the previous snapshot is not part of the state
+            self.__dict__.pop('_snapshot', None)
             self._snapshot = self._copy_container(self.__dict__)
 
     def make_immutable(self):
@@ -109,6 +118,557 @@ class ChangeCheckerMixin(object):
             return method_is_changed()
         return new_item != old_item
 
+    def diff(self):
+        ''' return a patch: the list of changes to self's state since the
+        last snapshot, as operations on paths. A path is a tuple starting
+        with an attribute name, followed by the keys and indices leading
+        to an item inside that attribute's containers:
+            ('set', path, value)     the item at path is now value
+            ('del', path)            the item at path was deleted
+            ('resize', path, n)      the sequence at path now has n items
+            ('patch', path, patch)   the instance at path changed: here is
+                                     its own diff()
+        Without a snapshot, the patch sets every attribute. Sequences are
+        compared index by index, so an item inserted at the front sets all
+        the items after it. The values in 'set' operations are the live
+        objects: write the patch out before changing them again. An
+        immutable instance never changes, so its patch is empty. '''
+        if self.immutable:
+            return []
+        snap = self.__dict__.pop('_snapshot', None)
+        try:
+            if snap is None:
+                return [('set', (name,), value)
+                        for name, value in self.__dict__.items()]
+            patch = []
+            self._diff_container(self.__dict__, snap, (), patch)
+            return patch
+        finally:
+            if snap is not None:
+                self._snapshot = snap
+
+    def _diff_container(self, container, snapshot, path, patch):
+        ''' append to patch the changes from snapshot to container '''
+        if isinstance(container, dict):
+            for k in snapshot:
+                if k not in container:
+                    patch.append(('del', path + (k,)))
+        elif len(container) != len(snapshot):
+            patch.append(('resize', path, len(container)))
+        for k, v in self.container_items[type(container)](container):
+            try:
+                snap_v = snapshot[k]
+            except LookupError:
+                patch.append(('set', path + (k,), v))
+            else:
+                self._diff_item(v, snap_v, path + (k,), patch)
+
+    def _diff_item(self, new_item, old_item, path, patch):
+        ''' like _check_item, but appending the changes to patch '''
+        if type(new_item) != type(old_item):
+            patch.append(('set', path, new_item))
+        elif type(new_item) in self.container_items:
+            self._diff_container(new_item, old_item, path, patch)
+        elif new_item is old_item:
+            method_diff = getattr(new_item, 'diff', None)
+            if method_diff is not None:
+                item_patch = method_diff()
+                if item_patch:
+                    patch.append(('patch', path, item_patch))
+            elif getattr(new_item, 'is_changed', lambda: False)():
+                patch.append(('set', path, new_item))
+        elif new_item != old_item:
+            patch.append(('set', path, new_item))
+
+    def apply_patch(self, patch):
+        ''' apply a patch made by diff(), bringing self (typically a copy
+        of the object diff() was called on, as of its last snapshot) up to
+        date '''
+        for op in patch:
+            kind, path = op[0], op[1]
+            if kind == 'patch':
+                self._follow(path).apply_patch(op[2])
+            elif kind == 'resize':
+                _resize(self._follow(path), op[2])
+            elif len(path) == 1:
+                if kind == 'set':
+                    setattr(self, path[0], op[2])
+                else:
+                    delattr(self, path[0])
+            else:
+                container = self._follow(path[:-1])
+                if kind == 'set':
+                    container[path[-1]] = op[2]
+                else:
+                    del container[path[-1]]
+
+    def _follow(self, path):
+        ''' the item found at path '''
+        item = getattr(self, path[0])
+        for k in path[1:]:
+            item = item[k]
+        return item
+
+
+def _resize(sequence, n):
+    ''' truncate sequence to n items, or pad it with None up to n items '''
+    if isinstance(sequence, list):
+        del sequence[n:]
+    while len(sequence) > n:
+        sequence.pop()
+    while len(sequence) < n:
+        sequence.append(None)
+
+
+"""Tracking Changes as They Happen Instead of Comparing Snapshots.
+
+ChangeCheckerMixin pays for every save twice: snapshot() copies the whole
+state, recursing into every list and dict, and is_changed() walks all of it
+again to compare. With millions of instances, the save loop spends most of
+its time there, and keeps a second copy of everything.
+
+DirtyTrackingMixin turns this around and lets changes announce themselves.
+Its __setattr__ and __delattr__ set a dirty flag, and list and dict
+attributes are stored as TrackedList and TrackedDict: subclasses whose
+mutating methods set the same flag, and which wrap the lists and dicts put
+into them in turn. is_changed() just reads the flag and snapshot() just
+clears it, so both are O(1) and there's no copy at all.
+
+The flag is a one-item list shared by the instance and its containers,
+rather than a reference from each container back to the instance, so that
+tracking creates no reference cycles for the garbage collector to deal
+with. Tracked containers pickle and copy as plain lists and dicts.
+
+Caveats: assigning a list or dict stores a tracked copy of it, so changes
+made through other references to the original aren't seen (nor do they
+show up in the attribute). Only lists and dicts are watched: an instance,
+set or array stored in an attribute must track its own changes. A
+container taken out of the instance still marks it dirty when changed, so
+is_changed() may err on the side of True, never the other way.
+"""
+
+
+def _marking(method):
+    """Wrap a mutating container method so that it sets the dirty flag."""
+    def mark_then_call(self, *args, **kwargs):
+        self._flag[0] = True
+        return method(self, *args, **kwargs)
+    mark_then_call.__name__ = method.__name__
+    return mark_then_call
+
+
+class TrackedList(list):
+    """A list that sets its owner's dirty flag whenever it changes."""
+    __slots__ = ('_flag',)
+
+    def __reduce__(self):
+        return list, (), None, iter(self)
+
+    def __setitem__(self, key, value):
+        self._flag[0] = True
+        if isinstance(key, slice):
+            value = [_track(item, self._flag) for item in value]
+        else:
+            value = _track(value, self._flag)
+        list.__setitem__(self, key, value)
+
+    def append(self, item):
+        self._flag[0] = True
+        list.append(self, _track(item, self._flag))
+
+    def insert(self, index, item):
+        self._flag[0] = True
+        list.insert(self, index, _track(item, self._flag))
+
+    def extend(self, items):
+        self._flag[0] = True
+        list.extend(self, [_track(item, self._flag) for item in items])
+
+    def __iadd__(self, items):
+        self.extend(items)
+        return self
+
+    for _name in ('__delitem__', '__imul__', 'pop', 'remove', 'clear',
+                  'sort', 'reverse'):
+        if hasattr(list, _name):
+            locals()[_name] = _marking(getattr(list, _name))
+    del _name
+
+
+class TrackedDict(dict):
+    """A dict that sets its owner's dirty flag whenever it changes."""
+    __slots__ = ('_flag',)
+
+    def __reduce__(self):
+        return dict, (), None, None, iter(self.items())
+
+    def __setitem__(self, key, value):
+        self._flag[0] = True
+        dict.__setitem__(self, key, _track(value, self._flag))
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return dict.__getitem__(self, key)
+
+    def update(self, *args, **kwargs):
+        self._flag[0] = True
+        for key, value in dict(*args, **kwargs).items():
+            dict.__setitem__(self, key, _track(value, self._flag))
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    for _name in ('__delitem__', 'pop', 'popitem', 'clear'):
+        if hasattr(dict, _name):
+            locals()[_name] = _marking(getattr(dict, _name))
+    del _name
+
+
+_tracked_types = {list: TrackedList, dict: TrackedDict,
+                  TrackedList: TrackedList, TrackedDict: TrackedDict}
+
+
+def _track(value, flag):
+    """Return value, with lists and dicts (at any depth) turned into
+    tracked containers reporting to flag."""
+    tracked_type = _tracked_types.get(type(value))
+    if tracked_type is None:
+        return value
+    if tracked_type is type(value) and value._flag is flag:
+        return value
+    tracked = tracked_type()
+    tracked._flag = flag
+    if tracked_type is TrackedList:
+        list.extend(tracked, [_track(item, flag) for item in value])
+    else:
+        dict.update(tracked, [(key, _track(item, flag))
+                              for key, item in value.items()])
+    return tracked
+
+
+class DirtyTrackingMixin(object):
+    """Drop-in alternative to ChangeCheckerMixin with O(1) is_changed()."""
+    immutable = False
+
+    def _dirty(self):
+        try:
+            return self.__dict__['_dirty_flag']
+        except KeyError:
+            # never saved: changed, as far as we know
+            flag = self.__dict__['_dirty_flag'] = [True]
+            return flag
+
+    def __setattr__(self, name, value):
+        flag = self._dirty()
+        flag[0] = True
+        object.__setattr__(self, name, _track(value, flag))
+
+    def __delattr__(self, name):
+        self._dirty()[0] = True
+        object.__delattr__(self, name)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_dirty_flag', None)
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    def snapshot(self):
+        ''' record that the current state has been saved '''
+        if not self.immutable:
+            self._dirty()[0] = False
+
+    def make_immutable(self):
+        self.immutable = True
+
+    def is_changed(self):
+        ''' True if self's state is changed since the last snapshot '''
+        if self.immutable:
+            return False
+        flag = self.__dict__.get('_dirty_flag')
+        return flag is None or flag[0]
+
+
+def benchmark_save_loop(count=100000):
+    """Time a save loop (is_changed, then snapshot) over count instances,
+    1% of which change between saves."""
+    import timeit
+
+    def make(mixin):
+        class Record(mixin):
+            def __init__(self, i):
+                self.id = i
+                self.name = 'record%d' % i
+                self.tags = ['a', 'b', 'c']
+                self.attrs = {'x': i, 'y': [i, i + 1]}
+        return [Record(i) for i in range(count)]
+
+    for mixin in (ChangeCheckerMixin, DirtyTrackingMixin):
+        records = make(mixin)
+        for record in records:
+            record.snapshot()
+
+        def save_loop():
+            for record in records[::100]:
+                record.attrs['y'].append(0)
+            saved = 0
+            for record in records:
+                if record.is_changed():
+                    record.snapshot()
+                    saved += 1
+            assert saved == len(records[::100])
+
+        print('%-20s %.3fs per save' % (
+            mixin.__name__, timeit.timeit(save_loop, number=3) / 3))
+
+
+"""Remembering a Digest of the State Instead of a Copy.
+
+The snapshot ChangeCheckerMixin keeps in _snapshot is a second copy of every
+list and dict the instance holds, so tracking changes doubles the memory
+used by the state.
+
+DigestChangeCheckerMixin keeps digests instead: 8-byte BLAKE2 hashes that
+stand for values. Each value is digested from a canonical encoding of it
+that includes its type (so 1, 1.0 and True differ): strings, ints,
+floats, bytes, None and booleans are encoded directly, other values are
+pickled. For an attribute holding a container (walked with the same
+container_items functions as ChangeCheckerMixin, so containers registered
+there work here too), snapshot() stores one 16-byte record per item, the
+digest of its index or key followed by the digest of its value, after the
+digest of the container's type; the records of a dict are sorted, so its
+order doesn't matter. A container held inside another is digested as the
+hash of its own records. is_changed() digests each attribute again and
+stops at the first one that differs from what was stored, and diff() uses
+the item records to set only the items that changed.
+
+Items with an is_changed method are digested by identity and asked
+themselves, like ChangeCheckerMixin does; snapshot() snapshots them. So
+are values that can't be pickled. A change goes unseen only if the new
+value has the same digest as the old one: about one chance in 2**64 (the
+built-in hash() is no good for this: hash(-1) == hash(-2), and ints
+2**61 - 1 apart have the same hash). The other way around, values that
+are equal but pickle differently (equal sets built in another order, say)
+count as changed. The memory saved is paid for in time: is_changed()
+hashes every value, which is several times slower than comparing them.
+"""
+
+_blake2b = hashlib.blake2b
+_type_digests = {}
+
+
+def _hash(data):
+    return _blake2b(data, digest_size=8).digest()
+
+
+def _identity_digest(value):
+    return _hash(b'o' + id(value).to_bytes(8, 'little'))
+
+
+def _leaf_digest(value):
+    ''' digest of a value that isn't a container '''
+    kind = type(value)
+    if kind is str:
+        data = b's' + value.encode('utf-8', 'surrogatepass')
+    elif kind is int:
+        data = b'i' + value.to_bytes(value.bit_length() // 8 + 1, 'little',
+                                     signed=True)
+    elif kind is float:
+        data = b'f' + struct.pack('<d', value)
+    elif kind is bytes:
+        data = b'b' + value
+    elif kind is bool or value is None:
+        data = b'c' + repr(value).encode('ascii')
+    else:
+        try:
+            data = b'p' + pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            return _identity_digest(value)
+    return _blake2b(data, digest_size=8).digest()
+
+
+# keys and indices repeat from one container to the next
+_key_digest = functools.lru_cache(maxsize=1 << 16, typed=True)(_leaf_digest)
+
+
+def _type_digest(kind):
+    digest = _type_digests.get(kind)
+    if digest is None:
+        digest = _type_digests[kind] = _hash(
+            ('t%s.%s' % (kind.__module__, kind.__name__)).encode('utf-8'))
+    return digest
+
+
+class DigestChangeCheckerMixin(ChangeCheckerMixin):
+    """ChangeCheckerMixin that stores digests of its state, not a copy."""
+
+    def snapshot(self):
+        if self.immutable:
+            return
+        state = self.__dict__
+        state.pop('_digests', None)
+        nested = []
+        digests = {}
+        for name, value in state.items():
+            digests[name] = self._state_digest(value, nested)
+        self._digests = digests
+        for obj in nested:
+            take_snapshot = getattr(obj, 'snapshot', None)
+            if take_snapshot is not None:
+                take_snapshot()
+
+    def make_immutable(self):
+        self.immutable = True
+        self.__dict__.pop('_digests', None)
+
+    def is_changed(self):
+        if self.immutable:
+            return False
+        state = self.__dict__
+        digests = state.get('_digests')
+        if digests is None:
+            return True
+        if len(state) != len(digests) + 1:
+            return True
+        nested = []
+        for name, value in state.items():
+            if name != '_digests' and digests.get(name) != self._state_digest(
+                    value, nested):
+                return True
+        return any(obj.is_changed() for obj in nested)
+
+    def diff(self):
+        ''' like ChangeCheckerMixin.diff, but only one level deep: the
+        patch sets the changed items of container attributes, and the
+        other changed attributes whole. A dict that lost keys is set whole
+        too, since its records don't tell which keys they were. '''
+        if self.immutable:
+            return []
+        state = self.__dict__
+        digests = state.get('_digests')
+        if digests is None:
+            return [('set', (name,), value) for name, value in state.items()]
+        patch = [('del', (name,)) for name in digests if name not in state]
+        for name, value in state.items():
+            if name == '_digests':
+                continue
+            old = digests.get(name)
+            nested = []
+            if (old == self._state_digest(value, nested) and
+                    not any(obj.is_changed() for obj in nested)):
+                continue
+            if (old is None or type(value) not in self.container_items or
+                    old[:8] != _type_digest(type(value)) or
+                    not self._diff_items(name, value, old, patch)):
+                patch.append(('set', (name,), value))
+        return patch
+
+    def _diff_items(self, name, value, old, patch):
+        ''' append to patch the items of the container value whose records
+        differ from those in old; return False, appending nothing, if the
+        items can't describe the change '''
+        old_values = dict((old[at:at + 8], old[at + 8:at + 16])
+                          for at in range(8, len(old), 16))
+        keys = set()
+        changes = []
+        for k, v in self.container_items[type(value)](value):
+            key = _key_digest(k)
+            keys.add(key)
+            nested = []
+            if (old_values.get(key) != self._digest(v, nested) or
+                    any(obj.is_changed() for obj in nested)):
+                changes.append(('set', (name, k), v))
+        if isinstance(value, dict):
+            if not keys.issuperset(old_values):
+                return False
+        elif len(value) != len(old_values):
+            patch.append(('resize', (name,), len(value)))
+        patch.extend(changes)
+        return True
+
+    def _state_digest(self, value, nested):
+        ''' what snapshot() stores for an attribute holding value: for a
+        container, its type's digest and a record per item; for anything
+        else, its digest. Items with an is_changed method are appended to
+        nested. '''
+        items = self.container_items.get(type(value))
+        if items is None:
+            return self._digest(value, nested)
+        digest = self._digest
+        records = [_key_digest(k) + digest(v, nested)
+                   for k, v in items(value)]
+        if isinstance(value, dict):
+            records.sort()
+        return _type_digest(type(value)) + b''.join(records)
+
+    def _digest(self, value, nested):
+        ''' 8-byte digest of value '''
+        if type(value) in self.container_items:
+            return _hash(self._state_digest(value, nested))
+        if hasattr(value, 'is_changed'):
+            nested.append(value)
+            return _identity_digest(value)
+        return _leaf_digest(value)
+
+
+def benchmark_snapshot_memory(count=20000):
+    """Memory kept by snapshots, and time per check, for count instances."""
+    import timeit
+    import tracemalloc
+
+    def make(mixin):
+        class Record(mixin):
+            def __init__(self, i):
+                self.id = i
+                self.name = 'record%d' % i
+                self.history = [{'day': d, 'amount': d * i} for d in range(10)]
+                self.tags = ['a', 'b', 'c']
+        return [Record(i) for i in range(count)]
+
+    for mixin in (ChangeCheckerMixin, DigestChangeCheckerMixin):
+        records = make(mixin)
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        for record in records:
+            record.snapshot()
+        kept = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        records[-1].history[5]['amount'] = -1
+        assert [r for r in records if r.is_changed()] == records[-1:]
+        seconds = timeit.timeit(lambda: [r.is_changed() for r in records],
+                                number=1)
+        print('%-26s %8.2f MB kept (%4d bytes each), check %.3fs' % (
+            mixin.__name__, kept / 1e6, kept // count, seconds))
+
+
+def benchmark_diff_volume(size=100000):
+    """Bytes written per save: the whole object vs. its diff()."""
+
+    class Document(ChangeCheckerMixin):
+        def __init__(self):
+            self.title = 'report'
+            self.lines = ['line %d' % i for i in range(size)]
+            self.meta = {'words': {str(i): i for i in range(size // 10)}}
+
+    doc = Document()
+    replica = copy.deepcopy(doc)
+    doc.snapshot()
+    doc.lines[500] = 'edited'
+    doc.lines.append('one more line')
+    doc.meta['words']['new'] = 1
+    patch = doc.diff()
+    replica.apply_patch(pickle.loads(pickle.dumps(patch)))
+    assert replica.lines == doc.lines and replica.meta == doc.meta
+    state = dict(doc.__dict__)
+    del state['_snapshot']
+    print('whole object: %8d bytes' % len(pickle.dumps(state)))
+    print('diff:         %8d bytes %r' % (len(pickle.dumps(patch)), patch))
+
 
 if __name__ == "__main__":
     class Example(ChangeCheckerMixin):
@@ -124,10 +684,14 @@ if __name__ == "__main__":
             return getattr(self.L, a)
 
     ex = Example('test')
-    print 'ex=', ex, 'is_changed=', ex.is_changed()
+    print('ex=', ex, 'is_changed=', ex.is_changed())
     # now, assume ex gets saved, then...:
     ex.snapshot()
-    print 'ex=', ex, 'is_changed=', ex.is_changed()
+    print('ex=', ex, 'is_changed=', ex.is_changed())
     # now we change ex...:
     ex.append('x')
-    print 'ex=', ex, 'is_changed=', ex.is_changed()
+    print('ex=', ex, 'is_changed=', ex.is_changed())
+
+    benchmark_save_loop()
+    benchmark_snapshot_memory()
+    benchmark_diff_volume()
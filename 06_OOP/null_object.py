@@ -11,6 +11,13 @@ By using such an instance as a placeholder, instead of None, you can avoid many
 conditional statements in your code and can often express algorithms with
 little or no checking for special values.
 """
+from __future__ import print_function
+
+import sys
+from collections import Counter
+from random import randint
+
+from singleton import create_once
 
 
 class Null(object):
@@ -18,10 +25,11 @@ class Null(object):
     # optional optimization: ensure only one instance per subclass
     # (essentially just to save memory, no functional difference)
     def __new__(cls, *args, **kwargs):
-        # make it a singleton
-        if '_instance' not in vars(cls):
-            cls._instance = super(Null, cls).__new__(cls)
-        return cls._instance
+        # make it a singleton; see singleton.py for thread and fork safety
+        instance = vars(cls).get('_instance')
+        if instance is None:
+            instance = create_once(cls, object.__new__)
+        return instance
 
     def __init__(self, *args, **kwargs):
         pass
@@ -34,6 +42,7 @@ class Null(object):
 
     def __nonzero__(self):
         return False
+    __bool__ = __nonzero__
 
     def __getattr__(self, name):
         return self
@@ -75,6 +84,117 @@ class SequentialNull(Null):
         return self
 
 
+"""Finding the Work Absorbed by Null Objects.
+
+A Null hides wasted work as well as bugs: a whole branch of computation can
+run against a Null receiver, every step silently absorbed. To find such
+branches, start_counting() makes the Null classes count what they absorb,
+per call site, until stop_counting().
+
+It costs nothing when it's off, because it doesn't add a test for an
+"enabled" flag to the Null methods: it swaps them. start_counting() replaces
+each absorbing method of Null and of its subclasses (__getattr__,
+__call__, __getitem__, ...) with a counting version, and stop_counting()
+puts the originals back. The counting versions are cheap too: they count
+every operation, but look at the call site only once every sample_every
+operations on average, with sys._getframe(1), which just follows one frame
+pointer instead of walking the stack the way traceback or inspect would.
+The gap between samples is random, so that a loop doing a fixed number of
+operations per iteration doesn't get sampled at the same places every
+time. The sampled counts are multiplied back up in the report, so hot sites show
+with their estimated number of operations.
+"""
+
+# the methods through which Null objects absorb operations
+_ABSORBING_METHODS = ('__call__', '__getattr__', '__setattr__', '__delattr__',
+                      '__getitem__', '__setitem__', '__delitem__', '__iter__',
+                      '__len__')
+
+
+class NullCounter(object):
+    """Operations absorbed by Null objects, and their sampled call sites."""
+
+    def __init__(self, sample_every):
+        self.sample_every = sample_every
+        self.countdown = sample_every
+        self.operations = Counter()
+        # (operation, file name, line number, function name) -> samples
+        self.sites = Counter()
+        self._originals = {}
+
+    def _counting(self, method, operation):
+        operations = self.operations
+        sites = self.sites
+        getframe = sys._getframe
+
+        def counting_method(null, *args, **kwargs):
+            operations[operation] += 1
+            self.countdown -= 1
+            if self.countdown <= 0:
+                self.countdown = randint(1, 2 * self.sample_every - 1)
+                frame = getframe(1)
+                code = frame.f_code
+                sites[operation, code.co_filename, frame.f_lineno,
+                      code.co_name] += 1
+            return method(null, *args, **kwargs)
+        counting_method.__name__ = method.__name__
+        return counting_method
+
+    def _install(self, cls):
+        for name in _ABSORBING_METHODS:
+            method = vars(cls).get(name)
+            # a class reached twice (through two parents) is wrapped once
+            if method is not None and (cls, name) not in self._originals:
+                self._originals[cls, name] = method
+                setattr(cls, name, self._counting(method, name.strip('_')))
+        for subclass in cls.__subclasses__():
+            self._install(subclass)
+
+    def _uninstall(self):
+        for (cls, name), method in self._originals.items():
+            setattr(cls, name, method)
+        self._originals.clear()
+
+    def report(self, top=10):
+        """The top call sites, as (estimated operations, operation,
+        'file:line', function) tuples, most operations first."""
+        return [(count * self.sample_every, operation,
+                 '%s:%d' % (filename, lineno), function)
+                for (operation, filename, lineno, function), count
+                in self.sites.most_common(top)]
+
+    def print_report(self, top=10):
+        print('%d operations absorbed: %s' % (
+            sum(self.operations.values()), ', '.join(
+                '%s %d' % item for item in self.operations.most_common())))
+        for count, operation, where, function in self.report(top):
+            print('  ~%-8d %-8s %s in %s' % (count, operation, where, function))
+
+
+_null_counter = None
+
+
+def start_counting(sample_every=100):
+    """Start counting the operations Null objects absorb; return the
+    NullCounter."""
+    global _null_counter
+    if _null_counter is not None:
+        raise RuntimeError('already counting')
+    _null_counter = NullCounter(sample_every)
+    _null_counter._install(Null)
+    return _null_counter
+
+
+def stop_counting():
+    """Restore the plain Null methods; return the NullCounter."""
+    global _null_counter
+    counter = _null_counter
+    if counter is not None:
+        counter._uninstall()
+        _null_counter = None
+    return counter
+
+
 """ Summary:
 The key goal of Null objects is to provide an intelligent replacement for the
 often-used primitive value None in Python. (Other languages represent the lack
@@ -135,7 +255,7 @@ if __name__ == "__main__":
             obj = compute(x, y)
             if obj is not None:
                 obj.append(100)
-            print obj
+            print(obj)
     print("============")
 
     # if return Null object when exception is thrown
@@ -143,4 +263,17 @@ if __name__ == "__main__":
         for y in ys:
             obj = compute_with_nullobj(x, y)
             obj.append(100)
-            print obj
+            print(obj)
+    print("============")
+
+    # which work is done for nothing, on Null objects?
+    def render(widget):
+        for i in range(1000):
+            widget.layout.width = i
+            widget.draw(i)
+
+    counter = start_counting(sample_every=10)
+    render(Null())
+    for item in SequentialNull():
+        pass
+    stop_counting().print_report()
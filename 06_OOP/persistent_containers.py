@@ -0,0 +1,644 @@
+"""Persistent Containers: Snapshots That Cost Nothing.
+
+Problem: ChangeCheckerMixin.snapshot() (see instance_snapshot.py) copies
+every list and dict the instance holds, so each snapshot costs as much as
+the state is big, even when a single item changed since the last one.
+
+Solution: keep the big containers in persistent data structures. A
+persistent container is never changed in place: "changing" it returns a
+new container that shares everything but the path to the change with the
+old one. Both are trees of nodes with 32 children each, so that path is
+log32(n) nodes long (4 nodes for a million items) and an update copies
+only those few small nodes:
+- PersistentVector is a bit-partitioned vector trie, with the last (up to)
+  32 items kept apart in a "tail" so that appending is cheap;
+- PersistentDict is a hash array mapped trie (HAMT): each level uses 5 bits
+  of the key's hash to pick a child, and a bitmap says which of the 32
+  children actually exist, so sparse nodes stay small.
+
+Since a persistent container can't change, a snapshot of it is just a
+reference to it. PersistentChangeCheckerMixin does just that, and to
+compare the current state with the snapshot, it walks both trees side by
+side, skipping every subtree they share (the same node object): the
+cost is proportional to the changes made, not to the size. The values
+kept in persistent containers should be immutable too: they are not
+copied by snapshots, nor asked if they changed. diff() puts a changed
+persistent container in the patch whole, to be set as is: it can't be
+patched in place, and it shares most of its nodes with the old one anyway.
+
+    class Inventory(PersistentChangeCheckerMixin):
+        def __init__(self):
+            self.stock = PersistentDict()
+
+        def receive(self, item, quantity):
+            self.stock = self.stock.set(item, self.stock.get(item, 0) +
+                                        quantity)
+"""
+from __future__ import print_function
+
+from instance_snapshot import ChangeCheckerMixin
+
+_BITS = 5
+_WIDTH = 1 << _BITS
+_MASK = _WIDTH - 1
+_HASH_BITS = 64
+
+try:
+    _popcount = int.bit_count
+except AttributeError:
+    def _popcount(n):
+        return bin(n).count('1')
+
+
+class PersistentVector(object):
+    """An immutable sequence with O(log32 n) set() and amortized O(1)
+    append(), sharing structure with the vector it was made from."""
+    __slots__ = ('_count', '_shift', '_root', '_tail')
+
+    def __init__(self, items=()):
+        self._count = 0
+        self._shift = _BITS
+        self._root = ()
+        self._tail = ()
+        if items:
+            built = self.extend(items)
+            self._count, self._shift, self._root, self._tail = (
+                built._count, built._shift, built._root, built._tail)
+
+    @classmethod
+    def _make(cls, count, shift, root, tail):
+        vector = cls.__new__(cls)
+        vector._count = count
+        vector._shift = shift
+        vector._root = root
+        vector._tail = tail
+        return vector
+
+    @property
+    def _tailoff(self):
+        return self._count - len(self._tail)
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self._count))]
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError('vector index out of range')
+        tailoff = self._tailoff
+        if index >= tailoff:
+            return self._tail[index - tailoff]
+        node = self._root
+        level = self._shift
+        while level > 0:
+            node = node[(index >> level) & _MASK]
+            level -= _BITS
+        return node[index & _MASK]
+
+    def __iter__(self):
+        for leaf in self._leaves(self._root, self._shift):
+            for item in leaf:
+                yield item
+        for item in self._tail:
+            yield item
+
+    def _leaves(self, node, level):
+        if level == 0:
+            yield node
+            return
+        for child in node:
+            for leaf in self._leaves(child, level - _BITS):
+                yield leaf
+
+    def append(self, item):
+        """Return a new vector with item added at the end."""
+        count = self._count
+        if len(self._tail) < _WIDTH:
+            return self._make(count + 1, self._shift, self._root,
+                              self._tail + (item,))
+        # the tail is full: move it into the trie
+        shift = self._shift
+        if (count >> _BITS) > (1 << shift):
+            # the trie is full too: add a level on top
+            root = (self._root, _new_path(shift, self._tail))
+            shift += _BITS
+        else:
+            root = _push_tail(count, shift, self._root, self._tail)
+        return self._make(count + 1, shift, root, (item,))
+
+    def extend(self, items):
+        vector = self
+        for item in items:
+            vector = vector.append(item)
+        return vector
+
+    def set(self, index, item):
+        """Return a new vector with item at index."""
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError('vector index out of range')
+        tailoff = self._tailoff
+        if index >= tailoff:
+            tail = list(self._tail)
+            tail[index - tailoff] = item
+            return self._make(self._count, self._shift, self._root,
+                              tuple(tail))
+        return self._make(self._count, self._shift,
+                          _set_in(self._shift, self._root, index, item),
+                          self._tail)
+
+    def changed_indices(self, other):
+        """Yield the indices whose items may differ (are not the same
+        object) in other, skipping the parts of the trie both share."""
+        if self is other:
+            return
+        shared = min(len(self), len(other))
+        start = 0
+        if self._shift == other._shift:
+            start = min(self._tailoff, other._tailoff)
+            for index in _changed_in(self._root, other._root, self._shift,
+                                     0, start):
+                yield index
+        for index in range(start, shared):
+            if self[index] is not other[index]:
+                yield index
+        for index in range(shared, max(len(self), len(other))):
+            yield index
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if not isinstance(other, PersistentVector):
+            return NotImplemented
+        return len(self) == len(other) and all(
+            self[index] == other[index]
+            for index in self.changed_indices(other))
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    __hash__ = None
+
+    def __copy__(self):
+        return self
+
+    def __reduce__(self):
+        return PersistentVector, (list(self),)
+
+    def __repr__(self):
+        return 'PersistentVector(%r)' % (list(self),)
+
+
+def _new_path(level, node):
+    """A branch of single-child nodes down to the leaf node."""
+    while level > 0:
+        node = (node,)
+        level -= _BITS
+    return node
+
+
+def _push_tail(count, level, parent, tail):
+    """Copy of parent with the full tail added as its last leaf; count is
+    the vector's size before the push."""
+    index = ((count - 1) >> level) & _MASK
+    if level == _BITS:
+        child = tail
+    elif index < len(parent):
+        child = _push_tail(count, level - _BITS, parent[index], tail)
+    else:
+        child = _new_path(level - _BITS, tail)
+    return parent[:index] + (child,) + parent[index + 1:]
+
+
+def _set_in(level, node, index, item):
+    """Copy of the path from node to index, with item at index."""
+    position = (index >> level) & _MASK
+    if level == 0:
+        child = item
+    else:
+        child = _set_in(level - _BITS, node[position], index, item)
+    return node[:position] + (child,) + node[position + 1:]
+
+
+def _changed_in(a, b, level, base, limit):
+    """Indices below limit where the tries a and b hold different items."""
+    if a is b:
+        return
+    for position in range(min(len(a), len(b))):
+        start = base + (position << level)
+        if start >= limit:
+            return
+        if level == 0:
+            if a[position] is not b[position]:
+                yield start
+        else:
+            for index in _changed_in(a[position], b[position],
+                                     level - _BITS, start, limit):
+                yield index
+
+
+class _Node(object):
+    """A HAMT node: entries are leaves (hash, key, value), _Nodes or
+    _Collisions, one for each bit set in bitmap, in bit order."""
+    __slots__ = ('bitmap', 'entries')
+
+    def __init__(self, bitmap, entries):
+        self.bitmap = bitmap
+        self.entries = entries
+
+
+class _Collision(object):
+    """Leaves whose keys have the same full hash."""
+    __slots__ = ('hash', 'leaves')
+
+    def __init__(self, hash_, leaves):
+        self.hash = hash_
+        self.leaves = leaves
+
+
+_EMPTY_NODE = _Node(0, ())
+# returned by the trie functions when a key is absent
+_MISSING = object()
+
+
+def _hash(key):
+    return hash(key) & ((1 << _HASH_BITS) - 1)
+
+
+def _entry_hash(entry):
+    return entry.hash if type(entry) is _Collision else entry[0]
+
+
+def _lookup(node, h, key):
+    shift = 0
+    while True:
+        bit = 1 << ((h >> shift) & _MASK)
+        if not node.bitmap & bit:
+            return _MISSING
+        entry = node.entries[_popcount(node.bitmap & (bit - 1))]
+        entry_type = type(entry)
+        if entry_type is _Node:
+            node = entry
+            shift += _BITS
+        elif entry_type is _Collision:
+            for leaf in entry.leaves:
+                if leaf[1] == key:
+                    return leaf[2]
+            return _MISSING
+        elif entry[0] == h and (entry[1] is key or entry[1] == key):
+            return entry[2]
+        else:
+            return _MISSING
+
+
+def _merge(shift, first, second):
+    """A subtree holding two entries with different positions."""
+    h1 = _entry_hash(first)
+    h2 = _entry_hash(second)
+    if h1 == h2:
+        leaves = (first.leaves if type(first) is _Collision else (first,))
+        return _Collision(h1, leaves + (second,))
+    i1 = (h1 >> shift) & _MASK
+    i2 = (h2 >> shift) & _MASK
+    if i1 == i2:
+        return _Node(1 << i1, (_merge(shift + _BITS, first, second),))
+    if i1 > i2:
+        first, second = second, first
+    return _Node((1 << i1) | (1 << i2), (first, second))
+
+
+def _assoc(node, shift, leaf):
+    """Return (node with leaf set, True if the key is new)."""
+    h = leaf[0]
+    bit = 1 << ((h >> shift) & _MASK)
+    position = _popcount(node.bitmap & (bit - 1))
+    entries = node.entries
+    if not node.bitmap & bit:
+        return _Node(node.bitmap | bit, entries[:position] + (leaf,) +
+                     entries[position:]), True
+    entry = entries[position]
+    entry_type = type(entry)
+    added = False
+    if entry_type is _Node:
+        new_entry, added = _assoc(entry, shift + _BITS, leaf)
+        if new_entry is entry:
+            return node, False
+    elif entry_type is _Collision and entry.hash == h:
+        leaves = entry.leaves
+        for index, old in enumerate(leaves):
+            if old[1] == leaf[1]:
+                if old[2] is leaf[2]:
+                    return node, False
+                leaves = leaves[:index] + (leaf,) + leaves[index + 1:]
+                break
+        else:
+            leaves += (leaf,)
+            added = True
+        new_entry = _Collision(h, leaves)
+    elif (entry_type is not _Collision and entry[0] == h and
+          (entry[1] is leaf[1] or entry[1] == leaf[1])):
+        if entry[2] is leaf[2]:
+            return node, False
+        new_entry = leaf
+    else:
+        new_entry = _merge(shift + _BITS, entry, leaf)
+        added = True
+    return _Node(node.bitmap, entries[:position] + (new_entry,) +
+                 entries[position + 1:]), added
+
+
+def _dissoc(node, shift, h, key):
+    """Return node without key (node itself if key is absent); a node
+    left with a single leaf is replaced by that leaf."""
+    bit = 1 << ((h >> shift) & _MASK)
+    if not node.bitmap & bit:
+        return node
+    position = _popcount(node.bitmap & (bit - 1))
+    entry = node.entries[position]
+    entry_type = type(entry)
+    if entry_type is _Node:
+        new_entry = _dissoc(entry, shift + _BITS, h, key)
+    elif entry_type is _Collision:
+        leaves = tuple(leaf for leaf in entry.leaves if leaf[1] != key)
+        if len(leaves) == len(entry.leaves):
+            return node
+        new_entry = (leaves[0] if len(leaves) == 1 else
+                     _Collision(entry.hash, leaves))
+    elif entry[0] == h and (entry[1] is key or entry[1] == key):
+        new_entry = None
+    else:
+        return node
+    if new_entry is entry:
+        return node
+    entries = node.entries
+    if new_entry is None:
+        entries = entries[:position] + entries[position + 1:]
+        bitmap = node.bitmap ^ bit
+    else:
+        entries = entries[:position] + (new_entry,) + entries[position + 1:]
+        bitmap = node.bitmap
+    if shift > 0 and not entries:
+        return None
+    if shift > 0 and len(entries) == 1 and type(entries[0]) is not _Node:
+        return entries[0]
+    return _Node(bitmap, entries)
+
+
+def _leaves_of(entry):
+    if type(entry) is _Node:
+        for child in entry.entries:
+            for leaf in _leaves_of(child):
+                yield leaf
+    elif type(entry) is _Collision:
+        for leaf in entry.leaves:
+            yield leaf
+    else:
+        yield entry
+
+
+def _changed_keys_in(a, b):
+    """Keys whose values may differ between the entries a and b."""
+    if a is b:
+        return
+    if type(a) is _Node and type(b) is _Node:
+        bits = a.bitmap | b.bitmap
+        while bits:
+            bit = bits & -bits
+            bits ^= bit
+            child_a = child_b = None
+            if a.bitmap & bit:
+                child_a = a.entries[_popcount(a.bitmap & (bit - 1))]
+            if b.bitmap & bit:
+                child_b = b.entries[_popcount(b.bitmap & (bit - 1))]
+            if child_a is None or child_b is None:
+                for leaf in _leaves_of(child_a if child_b is None
+                                       else child_b):
+                    yield leaf[1]
+            else:
+                for key in _changed_keys_in(child_a, child_b):
+                    yield key
+    else:
+        # different shapes: let the caller look the keys up
+        for entry in (a, b):
+            for leaf in _leaves_of(entry):
+                yield leaf[1]
+
+
+class PersistentDict(object):
+    """An immutable mapping (a hash array mapped trie) with O(log32 n)
+    set() and delete(), sharing structure with the dict it was made from."""
+    __slots__ = ('_root', '_count')
+
+    def __init__(self, items=()):
+        self._root = _EMPTY_NODE
+        self._count = 0
+        if items:
+            built = self.update(items)
+            self._root, self._count = built._root, built._count
+
+    @classmethod
+    def _make(cls, root, count):
+        mapping = cls.__new__(cls)
+        mapping._root = root
+        mapping._count = count
+        return mapping
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, key):
+        value = _lookup(self._root, _hash(key), key)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        value = _lookup(self._root, _hash(key), key)
+        return default if value is _MISSING else value
+
+    def __contains__(self, key):
+        return _lookup(self._root, _hash(key), key) is not _MISSING
+
+    def __iter__(self):
+        for leaf in _leaves_of(self._root):
+            yield leaf[1]
+
+    keys = __iter__
+
+    def values(self):
+        for leaf in _leaves_of(self._root):
+            yield leaf[2]
+
+    def items(self):
+        for leaf in _leaves_of(self._root):
+            yield leaf[1], leaf[2]
+
+    def set(self, key, value):
+        """Return a new dict with key set to value."""
+        root, added = _assoc(self._root, 0, (_hash(key), key, value))
+        if root is self._root:
+            return self
+        return self._make(root, self._count + added)
+
+    def delete(self, key):
+        """Return a new dict without key; raise KeyError if it's absent."""
+        root = _dissoc(self._root, 0, _hash(key), key)
+        if root is self._root:
+            raise KeyError(key)
+        return self._make(root, self._count - 1)
+
+    def update(self, items):
+        """Return a new dict with the items of a mapping or of an iterable
+        of (key, value) pairs added."""
+        if hasattr(items, 'items'):
+            items = items.items()
+        root = self._root
+        count = self._count
+        for key, value in items:
+            root, added = _assoc(root, 0, (_hash(key), key, value))
+            count += added
+        return self._make(root, count)
+
+    def changed_keys(self, other):
+        """Yield the keys whose values may differ (are not the same object)
+        in other, skipping the parts of the trie both share."""
+        return _changed_keys_in(self._root, other._root)
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if not isinstance(other, PersistentDict):
+            return NotImplemented
+        if len(self) != len(other):
+            return False
+        for key in self.changed_keys(other):
+            value = self.get(key, _MISSING)
+            if value is _MISSING or value != other.get(key, _MISSING):
+                return False
+        return True
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    __hash__ = None
+
+    def __copy__(self):
+        return self
+
+    def __reduce__(self):
+        return PersistentDict, (list(self.items()),)
+
+    def __repr__(self):
+        return 'PersistentDict({%s})' % ', '.join(
+            '%r: %r' % item for item in self.items())
+
+
+_persistent_types = (PersistentDict, PersistentVector)
+
+
+class PersistentChangeCheckerMixin(ChangeCheckerMixin):
+    """ChangeCheckerMixin whose snapshots keep persistent containers by
+    reference and compare them by walking only the unshared subtrees."""
+    container_items = dict(ChangeCheckerMixin.container_items)
+    container_items[PersistentDict] = PersistentDict.items
+    container_items[PersistentVector] = enumerate
+
+    def _copy_container(self, container):
+        if type(container) in _persistent_types:
+            return container
+        return ChangeCheckerMixin._copy_container(self, container)
+
+    def _check_container(self, container, snapshot):
+        if type(container) not in _persistent_types:
+            return ChangeCheckerMixin._check_container(
+                self, container, snapshot)
+        if container is snapshot:
+            return False
+        if len(container) != len(snapshot):
+            return True
+        if type(container) is PersistentDict:
+            changed = container.changed_keys(snapshot)
+        else:
+            changed = container.changed_indices(snapshot)
+        for k in changed:
+            try:
+                new_item, old_item = container[k], snapshot[k]
+            except LookupError:
+                return True
+            if self._check_item(new_item, old_item):
+                return True
+        return False
+
+    def _diff_container(self, container, snapshot, path, patch):
+        ''' a persistent container can't be changed item by item: if it
+        differs from its snapshot, the patch sets it whole (found by the
+        same walk as is_changed, skipping the shared subtrees) '''
+        if type(container) not in _persistent_types:
+            ChangeCheckerMixin._diff_container(
+                self, container, snapshot, path, patch)
+        elif self._check_container(container, snapshot):
+            patch.append(('set', path, container))
+
+
+def benchmark_snapshots(size=200000, number=20):
+    """Snapshot and check costs with a dict vs. a PersistentDict."""
+    import timeit
+
+    class Plain(ChangeCheckerMixin):
+        def __init__(self):
+            self.table = {i: str(i) for i in range(size)}
+
+        def change(self, i):
+            self.table[i] = 'changed'
+
+    class Persistent(PersistentChangeCheckerMixin):
+        def __init__(self):
+            self.table = PersistentDict((i, str(i)) for i in range(size))
+
+        def change(self, i):
+            self.table = self.table.set(i, 'changed')
+
+    for cls in (Plain, Persistent):
+        obj = cls()
+        obj.snapshot()
+        changes = iter(range(size))
+
+        def save():
+            obj.change(next(changes))
+            assert obj.is_changed()
+            obj.snapshot()
+            assert not obj.is_changed()
+
+        seconds = timeit.timeit(save, number=number) / number
+        print('%-10s change + check + snapshot: %.6fs' % (cls.__name__,
+                                                          seconds))
+
+
+if __name__ == "__main__":
+    v = PersistentVector(range(100))
+    w = v.set(50, 'x').append(100)
+    print(len(v), v[50], len(w), w[50], w[-1], list(w.changed_indices(v)))
+
+    d = PersistentDict({'a': 1, 'b': 2})
+    e = d.set('c', 3).delete('a')
+    print(d, e, list(e.changed_keys(d)))
+
+    class Inventory(PersistentChangeCheckerMixin):
+        def __init__(self):
+            self.stock = PersistentDict({'apples': 1, 'pears': 2})
+
+    inventory = Inventory()
+    inventory.snapshot()
+    replica = Inventory()
+    inventory.stock = inventory.stock.set('plums', 3)
+    patch = inventory.diff()
+    replica.apply_patch(patch)
+    print(patch, replica.stock == inventory.stock)
+
+    benchmark_snapshots()
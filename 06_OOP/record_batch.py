@@ -0,0 +1,303 @@
+"""Storing Many Records Column by Column.
+
+Problem: a list of a million super_tuple records (see named_tuple.py) is a
+million tuple objects, each with its header, a pointer per field and a
+separate object for every number it holds: several times the size of the
+data itself. And computing over one field means visiting every record.
+
+Solution: a RecordBatch keeps one column per field of the schema (a
+super_tuple or namedtuple class): an array.array of machine numbers when
+all the values are ints or floats, a list otherwise. A column of a million
+floats is then one 8 MB buffer. batch.x is the whole column of field x,
+batch[i] a small row view reading from the columns (call .as_tuple() for a
+real record), and len(batch) the number of records.
+
+filter() and sort() work a column at a time, instead of rebuilding every
+record: filter() runs itertools.compress over each column with the mask,
+and sort() computes the order of the rows once, then gathers each column
+in that order with one itemgetter call. When NumPy is installed and the
+mask or order is a NumPy array, NumPy indexing does the gathering:
+    adults = batch.filter([age >= 18 for age in batch.age])
+    oldest_first = batch.sort('age', reverse=True)
+    # with NumPy, masks are computed on the columns without copies:
+    adults = batch.filter(batch.to_numpy('age') >= 18)
+"""
+from __future__ import print_function
+
+from array import array
+from itertools import compress
+from operator import itemgetter
+
+# schema -> row view class
+_row_views = {}
+
+
+def _infer_typecode(values):
+    """'q' if values are all ints, 'd' if they're all floats, else None."""
+    kinds = set(map(type, values))
+    if kinds == {int}:
+        return 'q'
+    if kinds == {float}:
+        return 'd'
+    return None
+
+
+def _make_column(values, typecode=None):
+    """An array of values if they fit in one, otherwise a list."""
+    if not isinstance(values, (list, tuple)):
+        values = list(values)
+    if typecode is None:
+        typecode = _infer_typecode(values)
+    if typecode is not None:
+        try:
+            return array(typecode, values)
+        except (OverflowError, TypeError):
+            pass
+    return list(values)
+
+
+def _numpy_array(mask_or_order):
+    """mask_or_order if it's a NumPy array (NumPy is not imported for it)."""
+    if type(mask_or_order).__module__ == 'numpy':
+        return mask_or_order
+    return None
+
+
+def _take(column, indices):
+    """The items of column at indices, in a column of the same kind."""
+    if _numpy_array(indices) is not None:
+        if isinstance(column, array):
+            import numpy
+            taken = numpy.frombuffer(column, dtype=column.typecode)[indices]
+            result = array(column.typecode)
+            result.frombytes(taken.tobytes())
+            return result
+        indices = indices.tolist()
+    if len(indices) == 1:
+        items = [column[indices[0]]]
+    elif indices:
+        items = itemgetter(*indices)(column)
+    else:
+        items = ()
+    if isinstance(column, array):
+        return array(column.typecode, items)
+    return list(items)
+
+
+def _row_view_class(schema):
+    """A row view class with one property per field of schema."""
+    try:
+        return _row_views[schema]
+    except KeyError:
+        pass
+
+    class RowView(object):
+        """A row of a RecordBatch, read from its columns."""
+        __slots__ = ('_columns', '_index')
+
+        def __init__(self, columns, index):
+            self._columns = columns
+            self._index = index
+
+        def __len__(self):
+            return len(self._columns)
+
+        def __getitem__(self, position):
+            return self._columns[position][self._index]
+
+        def __iter__(self):
+            index = self._index
+            for column in self._columns:
+                yield column[index]
+
+        def as_tuple(self):
+            return schema._make(self)
+
+        def __eq__(self, other):
+            return tuple(self) == tuple(other)
+
+        def __ne__(self, other):
+            return not self == other
+
+        __hash__ = None
+
+        def __repr__(self):
+            return 'RowView(%r)' % (self.as_tuple(),)
+
+    def field(position):
+        return property(lambda self: self._columns[position][self._index])
+
+    for position, name in enumerate(schema._fields):
+        setattr(RowView, name, field(position))
+    return _row_views.setdefault(schema, RowView)
+
+
+class RecordBatch(object):
+    """Records of one schema stored as one column per field."""
+
+    def __init__(self, schema, columns, types=None):
+        """columns: one sequence of values per field, in field order, or a
+        dict mapping field names to them. types optionally maps field
+        names to array typecodes ('q', 'd', 'i', 'f', ...)."""
+        fields = schema._fields
+        if isinstance(columns, dict):
+            columns = [columns[name] for name in fields]
+        if len(columns) != len(fields):
+            raise ValueError('%d columns given for %d fields' %
+                             (len(columns), len(fields)))
+        types = types or {}
+        columns = [column if isinstance(column, array) and name not in types
+                   else _make_column(column, types.get(name))
+                   for name, column in zip(fields, columns)]
+        if len(set(map(len, columns))) > 1:
+            raise ValueError('columns have different lengths')
+        self.schema = schema
+        self.columns = columns
+        self._positions = dict((name, position)
+                               for position, name in enumerate(fields))
+        self._row_view = _row_view_class(schema)
+
+    def _with_columns(self, columns):
+        """A batch of the same schema around columns already made."""
+        batch = RecordBatch.__new__(RecordBatch)
+        batch.__dict__.update(self.__dict__)
+        batch.columns = columns
+        return batch
+
+    @classmethod
+    def from_rows(cls, schema, rows, types=None):
+        """Make a batch out of records (or any rows of field values)."""
+        rows = list(rows)
+        if not rows:
+            return cls(schema, [[] for name in schema._fields], types)
+        return cls(schema, list(zip(*rows)), types)
+
+    def to_rows(self):
+        """Return the list of records, as instances of the schema."""
+        rows = list(zip(*self.columns))
+        make_many = getattr(self.schema, 'make_many', None)
+        if make_many is not None:
+            return make_many(rows)
+        return list(map(self.schema._make, rows))
+
+    def column(self, name):
+        return self.columns[self._positions[name]]
+
+    def __getattr__(self, name):
+        positions = self.__dict__.get('_positions')
+        if positions is None or name not in positions:
+            raise AttributeError(name)
+        return self.columns[positions[name]]
+
+    def __len__(self):
+        return len(self.columns[0]) if self.columns else 0
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self._with_columns([column[index]
+                                       for column in self.columns])
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('batch index out of range')
+        return self._row_view(self.columns, index)
+
+    def __iter__(self):
+        row_view = self._row_view
+        columns = self.columns
+        for index in range(len(self)):
+            yield row_view(columns, index)
+
+    def take(self, indices):
+        """Return a batch of the rows at indices, in that order."""
+        return self._with_columns([_take(column, indices)
+                                   for column in self.columns])
+
+    def filter(self, mask):
+        """Return a batch of the rows whose item in mask is true."""
+        array_mask = _numpy_array(mask)
+        if array_mask is not None:
+            import numpy
+            indices = numpy.flatnonzero(array_mask)
+            return self.take(indices)
+        if not isinstance(mask, (list, tuple)):
+            mask = list(mask)
+        columns = []
+        for column in self.columns:
+            if isinstance(column, array):
+                columns.append(array(column.typecode, compress(column, mask)))
+            else:
+                columns.append(list(compress(column, mask)))
+        return self._with_columns(columns)
+
+    def where(self, name, predicate):
+        """Return a batch of the rows whose field name satisfies predicate."""
+        return self.filter(list(map(predicate, self.column(name))))
+
+    def sort(self, by, reverse=False):
+        """Return a batch sorted on one field, or a list of fields."""
+        names = [by] if isinstance(by, str) else list(by)
+        keys = [self.column(name) for name in names]
+        if len(keys) == 1:
+            key = keys[0].__getitem__
+        else:
+            key = lambda index: tuple(column[index] for column in keys)
+        order = sorted(range(len(self)), key=key, reverse=reverse)
+        return self.take(order)
+
+    def to_numpy(self, name):
+        """A NumPy array sharing the memory of an array column (a copy for
+        list columns)."""
+        import numpy
+        column = self.column(name)
+        if isinstance(column, array):
+            return numpy.frombuffer(column, dtype=column.typecode)
+        return numpy.array(column)
+
+    def __repr__(self):
+        return 'RecordBatch(%s, %d rows)' % (self.schema.__name__, len(self))
+
+
+if __name__ == "__main__":
+    import timeit
+    import tracemalloc
+
+    from named_tuple import super_tuple
+
+    Person = super_tuple('Person', 'name', 'age', 'height')
+    people = [Person('person%d' % i, i % 90, 150.0 + i % 50)
+              for i in range(5)]
+    batch = RecordBatch.from_rows(Person, people)
+    print(batch, batch.age, batch[2], batch[2].height)
+    print(batch.where('age', lambda age: age >= 2).sort('age',
+                                                        reverse=True).to_rows())
+
+    count = 1000000
+    tracemalloc.start()
+    people = [Person('p', i % 90, 150.0 + i % 50) for i in range(count)]
+    rows_memory = tracemalloc.get_traced_memory()[0]
+    batch = RecordBatch.from_rows(Person, people)
+    del people
+    batch_memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print('rows: %.1f MB, batch: %.1f MB' % (rows_memory / 1e6,
+                                             batch_memory / 1e6))
+    people = batch.to_rows()
+    print('sum of ages, rows:  %.3fs' % timeit.timeit(
+        lambda: sum(p.age for p in people), number=1))
+    print('sum of ages, batch: %.3fs' % timeit.timeit(
+        lambda: sum(batch.age), number=1))
+    print('filter, rows:  %.3fs' % timeit.timeit(
+        lambda: [p for p in people if p.age >= 18], number=1))
+    # without NumPy, the mask is built item by item in Python, and the
+    # values are copied into new columns: more work than collecting the
+    # references to the selected records
+    print('filter, batch: %.3fs' % timeit.timeit(
+        lambda: batch.filter([age >= 18 for age in batch.age]), number=1))
+    try:
+        ages = batch.to_numpy('age')
+    except ImportError:
+        pass
+    else:
+        print('filter, batch with NumPy mask: %.3fs' % timeit.timeit(
+            lambda: batch.filter(ages >= 18), number=1))
@@ -0,0 +1,287 @@
+"""Storing super_tuple Records in a Fixed-Width Binary File.
+
+Problem: you save super_tuple records (see named_tuple.py) with pickle.
+Pickle writes the class of every record and a type code for every value,
+so the file is bloated, and reading one record back means unpickling the
+whole file.
+
+Solution: when every field has a declared type of fixed size, all the
+records have the same binary layout and the same size, which the struct
+module can describe with one format string. RecordCodec compiles that
+format from the schema and the field types: int, float and bool (stored as
+'q', 'd' and '?'), any struct code ('i', 'H', 'f', '10s', ...), or
+(str, size) for text stored UTF-8 encoded in size bytes (longer text is
+cut, and a character cut in half is dropped). encode_many packs a list of
+records into one bytes object. To read many records back, from the
+fastest way to the slowest:
+- decode_array gives a NumPy structured array over the same bytes,
+  without copying them or making a single Python object;
+- decode_columns unpacks them with struct.iter_unpack into one list per
+  field (what RecordBatch, in record_batch.py, takes), decoding each text
+  column in one pass;
+- decode_many rebuilds a record object per record, with a loop generated
+  for the codec that unpacks, decodes the text and builds the tuple in
+  one step. Making a million tuples takes the same time however they are
+  made, so this is barely faster than pickle.loads: what the format gains
+  over pickle is its size and reading any record alone.
+
+RecordFile writes records after a small header (a magic string, the struct
+format and the field names, so that a file can't be read with the wrong
+codec) and reads them through mmap: record i lives at a known offset, so
+file[i] unpacks just those bytes, and the operating system reads in only
+the pages you touch. to_numpy() maps the whole file as a structured array.
+"""
+from __future__ import print_function
+
+import mmap
+import os
+import struct
+
+MAGIC = b'SUPT'
+# magic, length of the header text
+_PREFIX = struct.Struct('<4sI')
+_HEADER_ALIGNMENT = 8
+
+_type_codes = {int: 'q', float: 'd', bool: '?'}
+
+
+class RecordCodec(object):
+    """Packs records of a schema into fixed-width binary records."""
+
+    def __init__(self, schema, types):
+        """types maps each field of schema to int, float, bool, a struct
+        format code, or (str, size)."""
+        codes = []
+        text_fields = []
+        for position, name in enumerate(schema._fields):
+            declared = types[name]
+            if isinstance(declared, tuple) and declared[0] is str:
+                codes.append('%ds' % declared[1])
+                text_fields.append(position)
+            elif declared in _type_codes:
+                codes.append(_type_codes[declared])
+            else:
+                codes.append(declared)
+        self.schema = schema
+        self.codes = codes
+        self.format = '<' + ''.join(codes)
+        self._struct = struct.Struct(self.format)
+        self.size = self._struct.size
+        self._text_fields = text_fields
+        self._decode_rows = self._compile_decoder()
+
+    def _compile_decoder(self):
+        """A function turning the rows of iter_unpack into records."""
+        names = ['v%d' % position for position in range(len(self.codes))]
+        values = [
+            "%s.rstrip(b'\\0').decode('utf-8', 'ignore')" % name
+            if position in self._text_fields else name
+            for position, name in enumerate(names)]
+        if issubclass(self.schema, tuple):
+            make = '_tuple_new(_cls, (%s,))'
+        else:
+            make = '_make((%s,))'
+        source = ('def decode_rows(rows):\n'
+                  '    return [%s for %s in rows]\n' % (
+                      make % ', '.join(values), ', '.join(names) + ','))
+        namespace = {'_tuple_new': tuple.__new__, '_cls': self.schema,
+                     '_make': self.schema._make}
+        exec(source, namespace)
+        return namespace['decode_rows']
+
+    def _to_values(self, record):
+        if not self._text_fields:
+            return record
+        values = list(record)
+        for position in self._text_fields:
+            values[position] = values[position].encode('utf-8')
+        return values
+
+    def _from_values(self, values):
+        if self._text_fields:
+            values = list(values)
+            for position in self._text_fields:
+                values[position] = values[position].rstrip(
+                    b'\0').decode('utf-8', 'ignore')
+        return self.schema._make(values)
+
+    def encode(self, record):
+        return self._struct.pack(*self._to_values(record))
+
+    def decode(self, data, offset=0):
+        return self._from_values(self._struct.unpack_from(data, offset))
+
+    def encode_many(self, records):
+        pack = self._struct.pack
+        if self._text_fields:
+            records = map(self._to_values, records)
+        return b''.join([pack(*record) for record in records])
+
+    def decode_many(self, data):
+        """The list of records packed in data."""
+        return self._decode_rows(self._struct.iter_unpack(data))
+
+    def decode_columns(self, data):
+        """The records packed in data as one list per field, in field
+        order, without making record objects."""
+        columns = [list(column)
+                   for column in zip(*self._struct.iter_unpack(data))]
+        if not columns:
+            return [[] for code in self.codes]
+        for position in self._text_fields:
+            columns[position] = [
+                text.rstrip(b'\0').decode('utf-8', 'ignore')
+                for text in columns[position]]
+        return columns
+
+    def dtype(self):
+        """The NumPy structured dtype with the same layout."""
+        import numpy
+        return numpy.dtype([
+            (name, 'S' + code[:-1] if code.endswith('s') else '<' + code)
+            for name, code in zip(self.schema._fields, self.codes)])
+
+    def decode_array(self, data, offset=0, count=-1):
+        """A NumPy structured array over data (no copy: the array keeps
+        data alive, and text fields stay as UTF-8 bytes)."""
+        import numpy
+        return numpy.frombuffer(data, self.dtype(), count, offset)
+
+    def header(self):
+        text = ('%s\n%s' % (self.format, ','.join(self.schema._fields))
+                ).encode('utf-8')
+        size = _PREFIX.size + len(text)
+        text += b'\0' * (-size % _HEADER_ALIGNMENT)
+        return _PREFIX.pack(MAGIC, len(text)) + text
+
+
+class RecordFile(object):
+    """A file of fixed-width records, read by index through mmap."""
+
+    def __init__(self, path, codec):
+        self.path = path
+        self.codec = codec
+        header = codec.header()
+        self._offset = len(header)
+        with open(path, 'rb') as f:
+            if f.read(len(header)) != header:
+                raise ValueError('%s was not written with this codec (%s)'
+                                 % (path, codec.format))
+        self._file = open(path, 'rb')
+        self._map = None
+        self._remap()
+
+    @classmethod
+    def create(cls, path, codec, records=()):
+        """Write a new file holding records, and open it."""
+        with open(path, 'wb') as f:
+            f.write(codec.header())
+            f.write(codec.encode_many(records))
+        return cls(path, codec)
+
+    def _remap(self):
+        if self._map is not None:
+            self._map.close()
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._count = (len(self._map) - self._offset) // self.codec.size
+
+    def extend(self, records):
+        """Append records to the file."""
+        data = self.codec.encode_many(records)
+        with open(self.path, 'ab') as f:
+            f.write(data)
+        self._remap()
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        size = self.codec.size
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._count)
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            stop = max(start, stop)
+            return self.codec.decode_many(
+                self._map[self._offset + start * size:
+                          self._offset + stop * size])
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError('record index out of range')
+        return self.codec.decode(self._map, self._offset + index * size)
+
+    def __iter__(self):
+        chunk = max(1, (1 << 20) // self.codec.size)
+        for start in range(0, self._count, chunk):
+            for record in self[start:start + chunk]:
+                yield record
+
+    def to_numpy(self):
+        """A structured array mapping every record of the file; delete it
+        before closing the file."""
+        return self.codec.decode_array(self._map, self._offset, self._count)
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+if __name__ == "__main__":
+    import pickle
+    import tempfile
+    import timeit
+
+    from named_tuple import super_tuple
+
+    Trade = super_tuple('Trade', 'id', 'symbol', 'price', 'quantity', 'buy')
+    codec = RecordCodec(Trade, {'id': int, 'symbol': (str, 8),
+                                'price': float, 'quantity': 'i',
+                                'buy': bool})
+    trades = Trade.make_many([(i, 'SYM%d' % (i % 100), 100.0 + i % 7,
+                               i % 1000, i % 2 == 0)
+                              for i in range(1000000)])
+    print(codec.format, codec.size, 'bytes per record')
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'trades.bin')
+    pickled = pickle.dumps(trades, pickle.HIGHEST_PROTOCOL)
+    encoded = codec.encode_many(trades)
+    print('pickle: %d bytes, records: %d bytes' % (len(pickled), len(encoded)))
+    print('pickle.loads:          %.3fs' % timeit.timeit(
+        lambda: pickle.loads(pickled), number=1))
+    print('codec.decode_many:     %.3fs' % timeit.timeit(
+        lambda: codec.decode_many(encoded), number=1))
+    print('codec.decode_columns:  %.3fs' % timeit.timeit(
+        lambda: codec.decode_columns(encoded), number=1))
+    try:
+        codec.dtype()  # imports NumPy, not to be timed
+        print('codec.decode_array:    %.6fs' % timeit.timeit(
+            lambda: codec.decode_array(encoded), number=1))
+    except ImportError:
+        pass
+    assert codec.decode_many(encoded[:codec.size * 10]) == trades[:10]
+    assert codec.decode_columns(encoded[:codec.size * 10]) == [
+        list(column) for column in zip(*trades[:10])]
+
+    with RecordFile.create(path, codec, trades) as records:
+        print(len(records), records[123456], records[-1])
+        print('1000 random reads:  %.4fs' % timeit.timeit(
+            lambda: [records[i * 997] for i in range(1000)], number=1))
+        records.extend([Trade(-1, 'NEW', 1.5, 1, False)])
+        print(len(records), records[-1])
+        try:
+            table = records.to_numpy()
+        except ImportError:
+            pass
+        else:
+            print('mean price with NumPy: %.3f' % table['price'].mean())
+            del table
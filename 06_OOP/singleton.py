@@ -17,19 +17,146 @@ private constructors in Python, so you can't protect against multiple
 instantiations, other than just via convention in use of your API. I would
 still just put methods in a module, and consider the module as the singleton.
 """
+from __future__ import print_function
+
+import os
+import sys
+import threading
+import weakref
+
+"""Creating the instance safely with threads and fork().
+
+Checking vars(cls) and then setting cls._instance is a race: two threads can
+both see no instance and both create one. Taking a lock on every call would
+fix that, but every call would then pay for the lock, while the race can
+only happen before the instance exists. So create_once() uses double-checked
+locking: callers first look the instance up without any lock (the fast
+path, all that runs once the instance exists), and only when it's missing
+take a lock of the class's own and look again before creating it. The
+instance is stored in the class only once completely built, so no thread
+ever gets a half-initialized one.
+
+After os.fork(), the child has only the forking thread: a creation lock
+held by another thread at that moment would stay locked forever. A handler
+registered with os.register_at_fork gives every class new locks in the
+child, and drops the instance of the classes whose reset_in_child is true
+(say, an instance holding a socket or a thread), so that the child creates
+its own on first use.
+"""
+
+# guards the creation of the per-class locks
+_locks_lock = threading.Lock()
+# classes that went through create_once, to fix up after a fork
+_created_classes = weakref.WeakSet()
+
+
+def create_once(cls, create, *args):
+    """Return cls._instance, calling create(cls, *args) to make it if it
+    doesn't exist yet; thread-safe. Check vars(cls) first, without a lock,
+    and call this only when the instance is missing."""
+    lock = vars(cls).get('_creation_lock')
+    if lock is None:
+        with _locks_lock:
+            lock = vars(cls).get('_creation_lock')
+            if lock is None:
+                # reentrant, in case creating it needs the instance
+                lock = threading.RLock()
+                type.__setattr__(cls, '_creation_lock', lock)
+                _created_classes.add(cls)
+    with lock:
+        instance = vars(cls).get('_instance')
+        if instance is None:
+            instance = create(cls, *args)
+            type.__setattr__(cls, '_instance', instance)
+    return instance
+
+
+def _reset_after_fork():
+    global _locks_lock
+    _locks_lock = threading.Lock()
+    for cls in list(_created_classes):
+        type.__setattr__(cls, '_creation_lock', threading.RLock())
+        if getattr(cls, 'reset_in_child', False) and '_instance' in vars(cls):
+            type.__delattr__(cls, '_instance')
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
 
 
 class Singleton(object):
     """A Pythonic Singleton."""
+    # set to True in subclasses whose instance a forked child must not share
+    reset_in_child = False
+
     def __new__(cls, *args, **kwargs):
-        if '_instance' not in vars(cls):
-            # vars and __dict__,
-            # http://stackoverflow.com/questions/21297203/use-dict-or-vars
-            cls._instance = super(Singleton, cls).__new__(cls)
+        # vars and __dict__,
+        # http://stackoverflow.com/questions/21297203/use-dict-or-vars
+        instance = vars(cls).get('_instance')
+        if instance is None:
+            instance = create_once(cls, _new_singleton, *args)
+        return instance
+
+
+def _new_singleton(cls, *args):
+    instance = object.__new__(cls)
+    # only for testing
+    instance.data = list(args)
+    return instance
+
+
+def stress_test(threads=16, rounds=200):
+    """Let threads create a new Singleton subclass's instance all at once,
+    round after round, and count the rounds that made more than one."""
+    interval = sys.getswitchinterval()
+    # switch threads as often as possible, to make races likely
+    sys.setswitchinterval(1e-6)
+    try:
+        duplicated = 0
+        for round_number in range(rounds):
+            cls = type('Stress%d' % round_number, (Singleton,), {})
+            barrier = threading.Barrier(threads)
+            instances = []
+
+            def create():
+                barrier.wait()
+                instances.append(cls())
 
-            # only for testing
-            cls._instance.data = list(args)
-        return cls._instance
+            workers = [threading.Thread(target=create)
+                       for _ in range(threads)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            if any(instance is not instances[0] for instance in instances):
+                duplicated += 1
+    finally:
+        sys.setswitchinterval(interval)
+    print('%d threads x %d rounds: %d rounds created duplicates' % (
+        threads, rounds, duplicated))
+    return duplicated
+
+
+def fork_test():
+    """Check that a forked child gets working locks, and a new instance of
+    the classes with reset_in_child."""
+    class Shared(Singleton):
+        pass
+
+    class PerProcess(Singleton):
+        reset_in_child = True
+
+    shared, per_process = Shared(), PerProcess()
+    # a lock held by this thread during the fork must not block the child
+    Shared._creation_lock.acquire()
+    pid = os.fork()
+    if pid == 0:
+        ok = (Shared() is shared and PerProcess() is not per_process and
+              Shared._creation_lock.acquire(timeout=1))
+        os._exit(0 if ok else 1)
+    Shared._creation_lock.release()
+    _, status = os.waitpid(pid, 0)
+    print('fork: child %s' % ('ok' if status == 0 else 'FAILED'))
 
 
 """ Avoiding the "Singleton" Design Pattern with the Borg Idiom.
@@ -59,7 +186,7 @@ class BorgSingleton(object):
     _shared_state = {}
 
     def __new__(cls, *args, **kwargs):
-        obj = object.__new__(cls, *args, **kwargs)
+        obj = object.__new__(cls)
         obj.__dict__ = cls._shared_state
         return obj
 
@@ -119,10 +246,10 @@ in my paper available at http://www.aleax.it/5ep.html.)
 if __name__ == "__main__":
     s1 = Singleton('a', 'b', 1)
     # ['a', 'b', 1]
-    print s1.data
+    print(s1.data)
     s2 = Singleton(2, 3, 'c')
     # ['a', 'b', 1] ['a', 'b', 1]
-    print s1.data, s2.data
+    print(s1.data, s2.data)
 
     class SingletonSpam(Singleton):
         def __init__(self, arg):
@@ -167,19 +294,23 @@ if __name__ == "__main__":
     a = BorgSingletonExample('Zee')
     b = BorgSingletonExample()
     # instantiating b shares self.name with a
-    print a, b
+    print(a, b)
     c = BorgSingletonExample('Zi')
     # making c changes self.name of a & b too
-    print a, b, c
+    print(a, b, c)
     b.name = "Z"
     # setting b.name changes name of a & c too
-    print a, b, c
+    print(a, b, c)
 
-    print id(a), id(b), id(c)
+    print(id(a), id(b), id(c))
     singletons_dict = {}
     val = 0
     for i in a, b, c:
         singletons_dict[i] = val
         val += 1
     for i in a, b, c:
-        print i, singletons_dict[i]
+        print(i, singletons_dict[i])
+
+    stress_test()
+    if hasattr(os, 'fork'):
+        fork_test()